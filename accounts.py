@@ -0,0 +1,186 @@
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import io
+from itertools import islice
+import logging
+import os
+import sys
+
+from gae_validators import validateRequiredEmail
+from tornado.options import define, options
+
+import model
+
+
+# every column of an account except for the id, which is always assigned by the database on import
+COLUMNS = [field.column_name for field in model.Account._meta.sorted_fields if field.column_name != 'id']
+
+# peewee fills in defaults rather than the database, so anything missing from the file gets these instead
+DEFAULTS = dict((field.column_name, field.default) for field in model.Account._meta.sorted_fields
+    if field.column_name in COLUMNS and field.default is not None)
+
+BATCH_SIZE = 1000 # rows hashed at a time, memory use depends on this rather than the size of the file
+
+
+class RowStream(object):
+    """ a file like object that writes rows as CSV on demand, so COPY can read from a generator """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.data = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        # psycopg2 calls this with a size over and over until it gets back an empty string
+        while size < 0 or len(self.data) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow(row)
+            self.count += 1
+            self.data += self.buffer.getvalue()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+
+        if size < 0:
+            size = len(self.data)
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+
+def hashRow(row):
+    # runs in a worker process, and has to be a top level function to get there
+    if 'password' in row:
+        salt, hashed_password = model.Account.changePassword(row.pop('password'))
+        row['password_salt'] = salt.decode()
+        row['hashed_password'] = hashed_password
+    return row
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            break
+        yield batch
+
+
+def hashedRows(rows, executor, workers, batch_size=BATCH_SIZE):
+    # the next batch is hashing in the other processes while the previous one is written to the database
+    # so at most two batches are ever in memory
+    chunksize = max(1, batch_size // (workers * 4))
+    pending = None
+    for batch in batches(rows, batch_size):
+        hashing = executor.map(hashRow, batch, chunksize=chunksize)
+        if pending is not None:
+            yield from pending
+        pending = hashing
+    if pending is not None:
+        yield from pending
+
+
+def validRows(reader, skipped):
+    # cleans up each row from the file, and counts the ones that can't be imported
+    for row in reader:
+        valid, email = validateRequiredEmail((row.get('email') or '').strip())
+        has_password = row.get('password') or (row.get('password_salt') and row.get('hashed_password'))
+        if not valid or not has_password:
+            skipped['invalid'] += 1
+            continue
+
+        # emails are always lowercased on signup, so make sure imported ones can sign in too
+        row['email'] = email.lower()
+        for column, default in DEFAULTS.items():
+            if not row.get(column):
+                row[column] = default() if callable(default) else default
+        if row.get('password'):
+            row.pop('password_salt', None)
+            row.pop('hashed_password', None)
+        else:
+            row.pop('password', None)
+        yield row
+
+
+def exportAccounts(output):
+    """ writes every account to a CSV file, including its hashed password, and returns how many there were """
+    connection = model.newConnection()
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert('COPY (SELECT ' + ', '.join(['id'] + COLUMNS) + ' FROM account ORDER BY id) '
+            'TO STDOUT WITH CSV HEADER', output)
+        total = cursor.rowcount
+        connection.commit()
+    finally:
+        connection.close()
+
+    return total
+
+
+def importAccounts(source, workers=None, batch_size=BATCH_SIZE):
+    """ adds accounts from a CSV file, returns how many were added and how many were skipped """
+    # the file needs an `email` column, plus either a plain text `password` which gets hashed
+    # or the `password_salt` and `hashed_password` from an export, and it can have any other account columns
+    # emails that already have an account (or appear earlier in the file) are skipped
+    reader = csv.DictReader(source)
+    fieldnames = reader.fieldnames or []
+    always = ['password_salt', 'hashed_password'] + list(DEFAULTS)
+    columns = [column for column in COLUMNS if column in fieldnames or column in always]
+    skipped = {'invalid': 0}
+
+    rows = validRows(reader, skipped)
+    executor = None
+    if 'password' in fieldnames:
+        workers = workers or os.cpu_count()
+        executor = ProcessPoolExecutor(max_workers=workers)
+        rows = hashedRows(rows, executor, workers, batch_size=batch_size)
+    stream = RowStream([row.get(column) for column in columns] for row in rows)
+
+    connection = model.newConnection()
+    try:
+        cursor = connection.cursor()
+        # copying into a temporary table first means duplicates can be skipped in a single statement
+        # rather than failing the whole copy or checking every row one at a time
+        select = 'SELECT ' + ', '.join(columns) + ' FROM account'
+        cursor.execute('CREATE TEMPORARY TABLE account_import ON COMMIT DROP AS ' + select + ' WITH NO DATA')
+        cursor.copy_expert('COPY account_import (' + ', '.join(columns) + ') FROM STDIN WITH CSV', stream)
+        cursor.execute('INSERT INTO account (' + ', '.join(columns) + ') '
+            'SELECT DISTINCT ON (email) ' + ', '.join(columns) + ' FROM account_import i '
+            'WHERE NOT EXISTS (SELECT 1 FROM account a WHERE a.email = i.email) ORDER BY email')
+        added = cursor.rowcount
+        connection.commit()
+    finally:
+        connection.close()
+        if executor:
+            executor.shutdown()
+
+    skipped['existing'] = stream.count - added
+    return added, skipped
+
+
+if __name__ == '__main__':
+    define('workers', default=os.cpu_count(), help='processes to hash passwords with')
+
+    # NOTE: tornado stops reading options at the first argument, so they have to come before the action
+    args = options.parse_command_line()
+    if len(args) != 2 or args[0] not in ('import', 'export'):
+        sys.exit('Usage: python accounts.py [--workers=N] import|export FILE (use - for stdin or stdout)')
+
+    action, path = args
+    if action == 'export':
+        if path == '-':
+            total = exportAccounts(sys.stdout)
+        else:
+            with open(path, 'w', newline='') as f:
+                total = exportAccounts(f)
+        logging.info('Exported ' + str(total) + ' accounts.')
+    else:
+        if path == '-':
+            added, skipped = importAccounts(sys.stdin, workers=options.workers)
+        else:
+            with open(path, newline='') as f:
+                added, skipped = importAccounts(f, workers=options.workers)
+        logging.info('Imported %d accounts, skipped %d that already exist and %d without a valid email and password.',
+            added, skipped['existing'], skipped['invalid'])
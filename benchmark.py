@@ -0,0 +1,57 @@
+import logging
+import time
+
+from tornado.options import define, options
+
+import model
+
+
+def timeQuery(function, iterations):
+    # returns the average time per call in microseconds, after a warm up that also prepares the statement
+    for i in range(min(iterations, 100)):
+        function()
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1000000
+
+
+def benchmark(iterations=5000):
+    """ compares each hot query built by peewee with its prepared statement from `model.Prepared` """
+    account = model.Account.select().first()
+    auth = account and model.Auth.select().where(model.Auth.account == account).first()
+    if not auth:
+        raise Exception('The database needs at least one account with an auth to benchmark against.')
+
+    queries = [
+        ('account_by_id', lambda: model.Account.select().where(model.Account.id == account.id).first(),
+            lambda: model.Prepared.first('account_by_id', account.id)),
+        ('account_by_email', lambda: model.Account.select().where(model.Account.email == account.email).first(),
+            lambda: model.Prepared.first('account_by_email', account.email)),
+        ('auth_by_id', lambda: model.Auth.select().where(model.Auth.id == auth.id).first(),
+            lambda: model.Prepared.first('auth_by_id', auth.id)),
+        ('auth_by_account_user_agent', lambda: account.auths.where(model.Auth.user_agent == auth.user_agent).first(),
+            lambda: model.Prepared.first('auth_by_account_user_agent', account.id, auth.user_agent)),
+    ]
+
+    results = []
+    for name, peewee_query, prepared_query in queries:
+        peewee_us = timeQuery(peewee_query, iterations)
+        prepared_us = timeQuery(prepared_query, iterations)
+        results.append((name, peewee_us, prepared_us))
+        logging.info('%s: peewee %.1fus, prepared %.1fus, saved %.1fus per query', name, peewee_us, prepared_us,
+            peewee_us - prepared_us)
+
+    return results
+
+
+if __name__ == '__main__':
+    define('iterations', default=5000, help='how many times to run each query')
+
+    options.parse_command_line()
+
+    try:
+        benchmark(iterations=options.iterations)
+    finally:
+        model.peewee_db.close()
@@ -15,7 +15,14 @@ if env:
 # Auth
 AUTH_EXPIRES_DAYS = 30
 SESSION_KEY = os.environ.get('SESSION_KEY', b'replace with the output from base64.b64encode(os.urandom(64))')
+# where session data is kept: None for in its signed cookie, or 'postgres' or 'memory' for only an id in the cookie
+# NOTE: 'memory' is per process, so only use it in development or with a single worker (see sessions.py)
+SESSION_STORE = os.environ.get('SESSION_STORE')
 HOST = os.environ.get('HOST', 'localhost')
+# passwords are hashed with scrypt, where each step up in cost doubles the time and memory it takes
+# changing this upgrades each existing hash the next time its account logs in
+PASSWORD_HASH_COST = int(os.environ.get('PASSWORD_HASH_COST', '15'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 1))) # processes
 
 # Database
 DB_NAME = os.environ.get('DB_NAME', 'trestle')
@@ -24,6 +31,21 @@ DB_PASS = os.environ.get('DB_PASS', 'trestle_password')
 DB_HOST = os.environ.get('DB_HOST', 'localhost')
 DB_PORT = os.environ.get('DB_PORT', '5432')
 DB_SSLMODE = os.environ.get('DB_SSLMODE', 'allow')
+# connection pool - remember every worker process has its own, so keep the total under postgres' max_connections
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', '16'))
+DB_STALE_TIMEOUT = int(os.environ.get('DB_STALE_TIMEOUT', '300')) # seconds before a connection is recycled
+DB_POOL_WARM = int(os.environ.get('DB_POOL_WARM', '2')) # connections opened ahead of time at startup
+# threads for `model.async_db` - each one holds a pooled connection while it works, so keep this under the max
+DB_EXECUTOR_THREADS = int(os.environ.get('DB_EXECUTOR_THREADS', str(max(1, DB_MAX_CONNECTIONS // 2))))
+DB_EXECUTOR_QUEUE = int(os.environ.get('DB_EXECUTOR_QUEUE', '64')) # waiting work beyond this is rejected
+DB_ASYNC_MAX_CONNECTIONS = int(os.environ.get('DB_ASYNC_MAX_CONNECTIONS', '4')) # for asyncpg, see `model.AsyncDB`
+# an optional read replica, plain selects in read only requests go here when it's set (see `model.Replica`)
+DB_REPLICA_HOST = os.environ.get('DB_REPLICA_HOST')
+DB_REPLICA_PORT = os.environ.get('DB_REPLICA_PORT', DB_PORT)
+DB_REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', '2')) # seconds behind before reads use the primary
+DB_REPLICA_CONNECT_TIMEOUT = int(os.environ.get('DB_REPLICA_CONNECT_TIMEOUT', '2')) # seconds
+# warn about a request that runs the same query more than this many times, see `model.QueryStats`
+DB_QUERY_REPEAT_WARNING = int(os.environ.get('DB_QUERY_REPEAT_WARNING', '10'))
 
 # SendGrid
 # replace this with your own SendGrid API Key
@@ -6,44 +6,163 @@ import http.client
 from io import StringIO
 import json
 import logging
+import time
+import zlib
 
 # library imports
 from gae_validators import validateRequiredInt
 from tornado import escape, web
-from peewee import OperationalError
+from playhouse.pool import MaxConnectionsExceeded
 
 # local imports
 import helpers
 import model
+import sessions
 from config.constants import AUTH_EXPIRES_DAYS, HOST, SUPPORT_EMAIL
 from tasks import TaskConsumer, EmailTask
 
+# uncomment to encode sessions with msgpack, which is smaller and faster than JSON, otherwise they use compact JSON
+# import msgpack
+
+# comment out to enable msgpack
+msgpack = None
+
+
+class Session(object):
+    """ the session cookie's data, only verified and decoded if something reads it and only encoded if it changes """
+
+    # NOTE: changes are tracked by key, so set a nested value again after modifying it rather than only in place
+
+    # the first byte of the cookie says how the rest is encoded: lowercase as is, or uppercase when compressed
+    COMPRESS_OVER = 200 # bytes - compressing anything smaller than this usually makes it bigger
+
+    __slots__ = ('load', '_data', 'dirty')
+
+    def __init__(self, load=None):
+        # load is a function that returns the verified cookie, so nothing happens until the data is needed
+        self.load = load
+        self._data = None
+        self.dirty = False
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.decode(self.load and self.load())
+        return self._data
+
+    @classmethod
+    def decode(cls, raw):
+        if not raw:
+            return {}
+        kind, body = raw[:1], raw[1:]
+        try:
+            if kind == b'{':
+                # from before the encoding was marked, when it was always JSON
+                return json.loads(raw)
+            if kind.isupper():
+                kind, body = kind.lower(), zlib.decompress(body)
+            if kind == b'm' and msgpack:
+                return msgpack.unpackb(body, raw=False)
+            if kind == b'j':
+                return json.loads(body)
+        except (ValueError, zlib.error):
+            pass
+
+        # e.g. written with msgpack before it was turned off, so start over rather than error on every request
+        return {}
+
+    @classmethod
+    def encode(cls, data):
+        if msgpack:
+            kind, body = b'm', msgpack.packb(data, use_bin_type=True)
+        else:
+            kind, body = b'j', json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf8')
+
+        if len(body) > cls.COMPRESS_OVER:
+            compressed = zlib.compress(body, 9)
+            if len(compressed) < len(body):
+                kind, body = kind.upper(), compressed
+        return kind + body
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def pop(self, key, default=None):
+        if key in self.data:
+            self.dirty = True
+        return self.data.pop(key, default)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        if key not in self.data or self.data[key] != value:
+            self.dirty = True
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.dirty = True
+
+    def __contains__(self, key):
+        return key in self.data
+
 
 class BaseController(web.RequestHandler):
 
     # a mapping of field names to their validator functions
     FIELDS = {}
 
+    # set to False for handlers whose GET needs to read the very latest data, like right after a payment
+    READ_REPLICA = True
+
     def prepareSession(self):
-        # get a session store for this request
-        session = self.get_secure_cookie('session')
-        if session:
-            self.session = json.loads(session)
+        # get a session store for this request, which doesn't read the cookie until something uses it
+        if sessions.STORE:
+            self.session = Session(self.loadStoredSession)
         else:
-            self.session = {}
-        self.orig_session = dict(self.session)
+            self.session = Session(lambda: self.get_secure_cookie('session'))
+
+    def loadStoredSession(self):
+        # only a session that exists keeps its id, so a made up one can't be used to plant data for someone else
+        sid = self.get_cookie('sid')
+        data = sid and sessions.STORE.load(sid) or None
+        self.session_id = data and sid or None
+        return data
+
+    def get_secure_cookie(self, name, value=None, max_age_days=31, min_version=None):
+        # checking the signature isn't free and the same cookie can be read several times in a request
+        # so remember the result for the rest of it
+        if value is not None:
+            return super(BaseController, self).get_secure_cookie(name, value=value, max_age_days=max_age_days,
+                min_version=min_version)
+
+        if not hasattr(self, 'verified_cookies'):
+            self.verified_cookies = {}
+        key = (name, max_age_days, min_version)
+        if key not in self.verified_cookies:
+            self.verified_cookies[key] = super(BaseController, self).get_secure_cookie(name,
+                max_age_days=max_age_days, min_version=min_version)
+        return self.verified_cookies[key]
 
     async def prepare(self):
+        self.query_stats = model.QueryStats.start()
+        model.IdentityMap.start()
+
+        # reads in read only requests can go to the replica, unless this browser wrote something moments ago
+        # in which case the replica might not have it yet - this has to come before anything queries
+        # so that the connections borrowed for this request are kept track of too
+        # NOTE: this is a separate unsigned cookie so that checking it doesn't need the session
+        #       faking it only changes where that browser's own reads go
+        read_only = self.READ_REPLICA and self.request.method in ('GET', 'HEAD')
+        last_write = self.get_cookie('last_write', '')
+        recent_write = last_write.isdigit() and time.time() - int(last_write) < model.Replica.STICKY_SECONDS
+        model.Replica.route(replica=read_only and not recent_write)
+
         self.prepareSession()
 
-        # do this before `before` so that that method can use the db
-        try:
-            model.peewee_db.connect()
-        except OperationalError:
-            # this should not generally happen, but it is possible
-            # extreme example: the process gets killed mid request, so it doesn't have a chance to cleanup
-            # logging.warning('Database connection already open')
-            pass
+        # NOTE: there's no database connection yet - the first query borrows one from the pool (see model.py)
+        #       so requests that never touch the database, like cached pages, never use a connection at all
 
         if hasattr(self, "before"):
             # NOTE that self.path_args and self.path_kwargs are set as part of execute, so they aren't available here
@@ -53,7 +172,7 @@ class BaseController(web.RequestHandler):
             except Exception as e:
                 if not isinstance(e, web.Finish):
                     # if this isn't closing the request then the finish code is never called, so we do it here as well
-                    model.peewee_db.close()
+                    self.releaseConnection()
                 raise
 
         # don't run the regular action if there's already an error or redirect
@@ -66,14 +185,65 @@ class BaseController(web.RequestHandler):
         # NOTE that cookies set here aren't returned in the response, so they won't be set
         # this should be used for server-side cleanup only - assume that the response cannot be modified at this point
         # sadly attempts to do so won't throw any errors, and the browser won't see the changes (silent failure)
-        model.peewee_db.close()
+        self.releaseConnection()
+        model.ROUTE.set(None)
+        model.QUERIES.set(None)
+        model.IDENTITIES.set(None)
+
+        query_stats = getattr(self, 'query_stats', None)
+        if query_stats:
+            for shape, count in query_stats.repeated():
+                self.logger.warning('Query ran %d times in %s %s, possible N+1: %s', count, self.request.method,
+                    self.request.path, shape)
+
+    def finish(self, *args, **kwargs):
+        # only show query timing to developers - it's useful, but it also says a lot about how the app works
+        # NOTE: this checks for an already loaded user rather than looking one up and adding a query to count
+        query_stats = getattr(self, 'query_stats', None)
+        user = getattr(self, '_current_user', None)
+        if query_stats and not self._headers_written and (self.debug or (user and user.is_dev)):
+            self.set_header('Server-Timing', query_stats.serverTiming())
+        return super(BaseController, self).finish(*args, **kwargs)
+
+    def releaseConnection(self):
+        # only hand a connection back to the pool if a query during this request actually borrowed one
+        # NOTE: this doesn't go by whether the connection is open, which it might be for another request
+        route = model.ROUTE.get()
+        if route is not None:
+            route.release()
 
     def saveSession(self):
-        # this needs to be called anywhere we're finishing the response (rendering, redirecting, etc.)
-        if self.session != self.orig_session:
-            self.set_secure_cookie('session', json.dumps(self.session), expires_days=AUTH_EXPIRES_DAYS,
+        # remember when this browser last wrote something, so its next few requests read from the primary
+        # NOTE: this comes before saving a stored session, which doesn't count because those are always read from there
+        route = model.ROUTE.get()
+        if route is not None and route.wrote:
+            self.set_cookie('last_write', str(int(time.time())), max_age=model.Replica.STICKY_SECONDS,
                 domain=self.host, httponly=True, samesite='strict', secure=not self.debug)
 
+        # this needs to be called anywhere we're finishing the response (rendering, redirecting, etc.)
+        if self.session.dirty:
+            if sessions.STORE:
+                self.storeSession()
+            else:
+                self.set_secure_cookie('session', Session.encode(self.session.data), expires_days=AUTH_EXPIRES_DAYS,
+                    domain=self.host, httponly=True, samesite='strict', secure=not self.debug)
+            self.session.dirty = False
+
+    def storeSession(self):
+        # the cookie only holds an id, and an empty session doesn't need to be kept at all
+        sid = getattr(self, 'session_id', None)
+        if not self.session.data:
+            if sid:
+                sessions.STORE.delete(sid)
+            return
+
+        if not sid:
+            sid = self.session_id = sessions.newSessionId()
+        # set every time so the cookie expires along with the stored session, like the signed one does
+        self.set_cookie('sid', sid, expires_days=AUTH_EXPIRES_DAYS, domain=self.host, httponly=True,
+            samesite='strict', secure=not self.debug)
+        sessions.STORE.save(sid, Session.encode(self.session.data), AUTH_EXPIRES_DAYS * 86400)
+
     @property
     def logger(self):
         return logging.getLogger('tornado.application')
@@ -90,6 +260,11 @@ class BaseController(web.RequestHandler):
     def host(self):
         return self.debug and self.request.host.split(':', 1)[0] or HOST
 
+    def uncacheAccount(self, account):
+        # an account is cached once for every auth it's signed in with (see `get_current_user`)
+        for auth in account.auths:
+            helpers.uncache('auth_' + auth.slug)
+
     def flash(self, message, level='info'):
         self.session["flash"] = {"level": level, "message": message}
 
@@ -226,6 +401,14 @@ class BaseController(web.RequestHandler):
 
     # this overrides the base class for handling things like 500 errors
     def write_error(self, status_code, exc_info=None):
+        if exc_info and issubclass(exc_info[0], (MaxConnectionsExceeded, model.DatabaseBusy)):
+            # the database is overloaded, so tell the client to back off rather than alert about a bug
+            self.logger.warning('Database overloaded: ' + str(exc_info[1]))
+            self._current_user = None # looking up the user would need a connection too
+            if not hasattr(self, 'session'):
+                self.prepareSession()
+            return self.renderError(503)
+
         # if this is development, then include a stack trace
         stacktrace = None
         message = None
@@ -262,6 +445,11 @@ class BaseController(web.RequestHandler):
                 def getUser():
                     return model.Account.getByAuth(int_slug)
                 account = helpers.cache('auth_' + slug, getUser, debug=self.debug)
+                # so that looking the account up again during this request gives back this same instance
+                account = model.IdentityMap.add(account)
+                if account:
+                    # record that this auth is still in use, which is written later along with all the others
+                    model.AuthTouches.touch(int_slug, self.request.remote_ip or '')
 
             if not account:
                 self.clear_cookie('auth_key', domain=self.host)
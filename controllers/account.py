@@ -18,7 +18,7 @@ def validatePassword(source):
 
 class BaseLoginController(BaseController):
 
-    def login(self, user, new=False, remember=False):
+    async def login(self, user, new=False, remember=False):
         ua = self.request.headers.get('User-Agent', '')
         if ua.startswith('Tornado'):
             # this is a change in tornado 6.1 - instead of returning nothing if the user agent is missing
@@ -32,13 +32,10 @@ class BaseLoginController(BaseController):
 
         auth = None
         if not new:
-            auth = user.getAuth(ua)
+            # note that we want to touch this even if it isn't different because it updates the last modified
+            auth = await model.AsyncDB.touchAuth(user, ua, ip)
 
-        if auth:
-            # note that we want to save this even if it isn't different because it updates the last modified
-            auth.ip = ip
-            auth.save()
-        else:
+        if not auth:
             parsed = httpagentparser.detect(ua)
             os = browser = device = ''
             if 'os' in parsed:
@@ -49,8 +46,7 @@ class BaseLoginController(BaseController):
             if 'dist' in parsed:
                 # "dist" stands for "distribution" - like Android, iOS
                 device = parsed['dist']['name']
-            auth = model.Auth(user_agent=ua, os=os, browser=browser, device=device, ip=ip, account=user)
-            auth.save()
+            auth = await model.AsyncDB.createAuth(user, ua, ip, os=os, browser=browser, device=device)
 
         expires_days = remember and AUTH_EXPIRES_DAYS or None
         self.set_secure_cookie('auth_key', auth.slug, expires_days=expires_days, domain=HOST,
@@ -92,7 +88,7 @@ class IndexController(BaseController):
     #             return self.redisplay({}, errors)
 
     #     self.current_user.save()
-    #     helpers.uncache(self.current_user.slug)
+    #     self.uncacheAccount(self.current_user)
     #     self.redisplay()
 
 
@@ -136,8 +132,8 @@ class AuthsController(BaseController):
 
             return self.renderError(403)
 
-        auth.delete_instance()
-        helpers.uncache(valid_data['auth_key'])
+        await model.AsyncDB.deleteAuth(auth.id)
+        helpers.uncache('auth_' + valid_data['auth_key'])
 
         if app:
             return self.renderJSON({'ok': '1'})
@@ -162,10 +158,7 @@ class EmailController(BaseController):
         app = self.get_argument('app', None)
         form_data, errors, valid_data = self.validate()
 
-        hashed_password = model.Account.hashPassword(valid_data["password"],
-            self.current_user.password_salt.encode('utf8'))
-
-        if hashed_password != self.current_user.hashed_password:
+        if not await model.Passwords.check(self.current_user, valid_data["password"]):
             errors["match"] = True
 
         # extra validation to make sure that email address isn't already in use
@@ -173,7 +166,7 @@ class EmailController(BaseController):
             # note that emails are supposed to be case sensitive according to RFC 5321
             # however in practice users consistenly expect them to be case insensitive
             email = valid_data["email"].lower()
-            user = model.Account.getByEmail(email)
+            user = await model.AsyncDB.getByEmail(email)
             if user:
                 errors["exists"] = True
 
@@ -188,7 +181,7 @@ class EmailController(BaseController):
 
         self.current_user.email = email
         self.current_user.save()
-        helpers.uncache(self.current_user.slug)
+        self.uncacheAccount(self.current_user)
 
         if app:
             return self.renderJSON({'ok': '1'})
@@ -213,10 +206,7 @@ class PasswordController(BaseController):
         form_data, errors, valid_data = self.validate()
 
         if not errors:
-            hashed_password = model.Account.hashPassword(valid_data["password"],
-                self.current_user.password_salt.encode('utf8'))
-
-            if hashed_password != self.current_user.hashed_password:
+            if not await model.Passwords.check(self.current_user, valid_data["password"]):
                 errors["match"] = True
 
         if errors:
@@ -230,12 +220,12 @@ class PasswordController(BaseController):
 
             return self.redisplay(form_data, errors)
 
-        password_salt, hashed_password = model.Account.changePassword(valid_data["new_password"])
+        password_salt, hashed_password = await model.Passwords.change(valid_data["new_password"])
 
         self.current_user.password_salt = password_salt
         self.current_user.hashed_password = hashed_password
         self.current_user.save()
-        helpers.uncache(self.current_user.slug)
+        self.uncacheAccount(self.current_user)
 
         if app:
             return self.renderJSON({'ok': '1'})
@@ -265,7 +255,7 @@ class SignupController(BaseLoginController):
         if not errors:
             # FUTURE: keep an un-lowered copy of this for potential display?
             valid_data["email"] = valid_data["email"].lower()
-            user = model.Account.getByEmail(valid_data["email"])
+            user = await model.AsyncDB.getByEmail(valid_data["email"])
             if user:
                 errors["exists"] = True
 
@@ -274,12 +264,12 @@ class SignupController(BaseLoginController):
                 del form_data["password"] # never send password back for security
             self.redisplay(form_data, errors)
         else:
-            password_salt, hashed_password = model.Account.changePassword(valid_data["password"])
+            password_salt, hashed_password = await model.Passwords.change(valid_data["password"])
             del valid_data["password"]
 
             user = model.Account(password_salt=password_salt, hashed_password=hashed_password, **valid_data)
             user.save()
-            self.login(user, new=True)
+            await self.login(user, new=True)
 
 
 class LoginController(BaseLoginController):
@@ -299,14 +289,12 @@ class LoginController(BaseLoginController):
         # check that the user exists and the password matches
         user = None
         if not errors:
-            user = model.Account.getByEmail(valid_data["email"].lower())
-            if user:
-                hashed_password = model.Account.hashPassword(valid_data["password"], user.password_salt.encode('utf8'))
-                if hashed_password != user.hashed_password:
-                    # note that to dissuade brute force attempts the error for not finding the user
-                    # and not matching the password should be the same
-                    errors["match"] = True
-            else:
+            user = await model.AsyncDB.getByEmail(valid_data["email"].lower())
+            # this also upgrades a password stored with an older hash, since it's the only time we know it
+            # and without a user it takes just as long, so the response time doesn't reveal which emails exist
+            if not await model.Passwords.check(user, valid_data["password"]):
+                # note that to dissuade brute force attempts the error for not finding the user
+                # and not matching the password should be the same
                 errors["match"] = True
 
         if errors:
@@ -314,7 +302,7 @@ class LoginController(BaseLoginController):
                 del form_data["password"] # never send password back for security
             self.redisplay(form_data, errors)
         else:
-            self.login(user, remember=valid_data["remember"])
+            await self.login(user, remember=valid_data["remember"])
 
 
 class LogoutController(BaseController):
@@ -322,7 +310,7 @@ class LogoutController(BaseController):
     @web.authenticated
     async def post(self):
         slug = self.get_secure_cookie('auth_key').decode()
-        model.Auth.delete().where(model.Auth.id == slug).execute()
+        await model.AsyncDB.deleteAuth(slug)
         helpers.uncache('auth_' + slug)
 
         self.clear_all_cookies(domain=self.host)
@@ -347,7 +335,7 @@ class ForgotPasswordController(BaseController):
             self.redisplay(form_data, errors)
         else:
             # for security, don't alert them if the user doesn't exist
-            user = model.Account.getByEmail(valid_data["email"].lower())
+            user = await model.AsyncDB.getByEmail(valid_data["email"].lower())
             if user:
                 token = user.resetPassword()
                 self.deferEmail([user.email], "Reset Password", "reset_password.html",
@@ -397,7 +385,7 @@ class ResetPasswordController(BaseLoginController):
         if errors:
             self.redisplay(form_data, errors, "/account/resetpassword?key=" + self.key + "&token=" + self.token)
         else:
-            password_salt, hashed_password = model.Account.changePassword(valid_data["password"])
+            password_salt, hashed_password = await model.Passwords.change(valid_data["password"])
             del valid_data["password"]
             self.reset_user.password_salt = password_salt
             self.reset_user.hashed_password = hashed_password
@@ -406,7 +394,7 @@ class ResetPasswordController(BaseLoginController):
             self.reset_user.save()
 
             # need to uncache so that changes to the user object get picked up by the cache
-            helpers.uncache(self.reset_user.slug)
+            self.uncacheAccount(self.reset_user)
             self.flash("Your password has been changed. You have been logged in with your new password.",
                 level="success")
-            self.login(self.reset_user)
+            await self.login(self.reset_user)
@@ -15,7 +15,13 @@ class DevController(BaseController):
             return self.renderError(403)
 
     async def get(self):
-        self.renderTemplate('dev.html')
+        cache_stats = helpers.STATS.toDict()
+        db_stats = model.DB_EXECUTOR.toDict()
+
+        if self.get_argument('app', None):
+            return self.renderJSON({'cache': cache_stats, 'db_executor': db_stats})
+
+        self.renderTemplate('dev.html', cache_stats=cache_stats, db_stats=db_stats)
 
     async def post(self):
 
@@ -33,7 +39,7 @@ class DevController(BaseController):
                     user.save()
 
                     # the user may currently be signed in so invalidate its cache to get the new permissions
-                    helpers.uncache(user.slug)
+                    self.uncacheAccount(user)
                     self.logger.info('Made user admin: ' + valid_data['email'])
                     self.flash('User successfully made admin.', level='success')
                 else:
@@ -41,18 +47,6 @@ class DevController(BaseController):
             if errors:
                 return self.redisplay(form_data, errors)
 
-        elif self.get_argument('migrate', None):
-            self.logger.info('Beginning migration.')
-
-            # FUTURE: probably want to move this to a script outside the webserver
-            # change and uncomment to do migration work
-            # can also use a dictionary instead of kwargs here
-            # q = model.User.update(model.User.prop='value').where()
-            total = 0 # q.execute()
-
-            self.logger.info('Migration finished. Modified ' + str(total) + ' items.')
-            self.flash('Migrations Complete', level='success')
-
         elif self.get_argument('reset', None) and self.debug:
             # use model.py to reset the db, then you can run this to add fixture data
             model.reset()
@@ -5,6 +5,7 @@ from tornado import ioloop
 from tornado.options import define, options
 
 import model
+import sessions
 
 
 class Cron(object):
@@ -38,7 +39,7 @@ class Cron(object):
         logging.info('Cron started, debug is ' + str(debug))
 
         # the first callback gets added with a timer so it runs at the correct time
-        jobs = [AuthCron]
+        jobs = [AuthCron, SessionCron]
 
         now = datetime.utcnow()
         today = now.date()
@@ -64,11 +65,47 @@ class AuthCron(Cron):
     @classmethod
     def run(cls, debug=False):
 
-        days_ago = datetime.utcnow() - timedelta(cls.MAX_DAYS)
-        total = model.Auth.delete().where(model.Auth.modified_dt < days_ago).execute()
+        now = datetime.utcnow()
+        days_ago = now - timedelta(cls.MAX_DAYS)
+
+        try:
+            # roll the weekly partitions forward and drop the ones that have expired entirely
+            added = model.Auth.addPartitions(now)
+            dropped = model.Auth.dropPartitions(days_ago)
+            logging.info('Added auth partitions ' + str(added) + ', dropped ' + str(dropped))
+
+            # that leaves at most a week's worth of expired auths in the oldest partitions (and the default one)
+            # which are trimmed in batches so auths still expire after exactly `MAX_DAYS`
+            total = model.Auth.deleteInBatches(model.Auth.modified_dt < days_ago)
+        finally:
+            # this runs on a cron thread, so hand its connection back to the pool rather than holding it until tomorrow
+            model.peewee_db.close()
 
         logging.info('Removed ' + str(total) + ' old auths.')
 
+        return total
+
+
+class SessionCron(Cron):
+
+    RUN_AT = time(8, 30) # time of day, assumed to be UTC
+    FREQUENCY = 86400000 # in ms
+
+    @classmethod
+    def run(cls, debug=False):
+        # only a shared store can be cleaned up from here, the memory store cleans up after itself in each worker
+        if not isinstance(sessions.STORE, sessions.PostgresSessionStore):
+            return 0
+
+        try:
+            total = sessions.STORE.cleanup()
+        finally:
+            model.peewee_db.close()
+
+        logging.info('Removed ' + str(total) + ' expired sessions.')
+
+        return total
+
 
 if __name__ == '__main__':
     define('debug', default=False, help='enable debug')
@@ -6,6 +6,10 @@ poetry install
 # yarn install
 # yarn build
 
+# build new indexes before the new code starts
+# one time migrations can lock tables, so those are run by hand when traffic is low with `--migrations`
+poetry run python migrate.py
+
 service supervisor restart
 
 # only need to restart nginx if config has changed
@@ -1,19 +1,430 @@
+import asyncio
+from collections import OrderedDict
+import gzip
+import hashlib
+import json
+import logging
+import os
 import re
+import sys
+import threading
+import time
 from urllib.parse import quote_plus
+import uuid
 
 import htmlmin
+from tornado import template
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
 
 # uncomment if you want to enable memcache
 # note that server_max_value_length has to also be set in memcache config to work properly
 # default max value is 1 MB, see https://stackoverflow.com/a/18182563
 # import memcache
-# MCACHE = memcache.Client(['localhost', '11211']) # , server_max_value_length=1024 * 1024 * 10) # 10 MB
+# MCACHE = memcache.Client(['localhost:11211']) # , server_max_value_length=1024 * 1024 * 10) # 10 MB
 
 # comment out or remove at least the first line (or all of this block) to enabled memcache
+# when memcache is enabled it becomes a shared L2 behind a small per process L1 LRU (see `makeCache` below)
 MCACHE = None
-CACHE = {}
-CACHE_KEYS = []
+CACHE_L1_MAX_SIZE = 32 # number of unique entries kept in each process in front of memcache
+CACHE_L1_EXPIRES = 60 # seconds, bounds how stale a value copied from memcache can be in a single process
 CACHE_MAX_SIZE = 128 # number of unique entries
+CACHE_MAX_BYTES = 16 * (2 ** 20) # 16 MB total across all entries
+CACHE_MAX_ITEM_BYTES = CACHE_MAX_BYTES // 8 # anything bigger than this is never stored
+
+# uncomment to also precompress cached pages with brotli, which needs the `brotli` package installed
+# import brotli
+# BROTLI = brotli
+
+# comment out to enable brotli
+BROTLI = None
+
+
+def sizeof(value):
+    # a rough estimate of how much memory a cached value is holding on to
+    # exact accounting isn't the goal - just something proportional enough to bound the cache by
+    size = sys.getsizeof(value)
+    if isinstance(value, (str, bytes, bytearray, int, float, bool)) or value is None:
+        return size
+    if isinstance(value, dict):
+        return size + sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + sum(sizeof(v) for v in value)
+    # peewee models keep their field values in `__data__`, other objects in `__dict__`
+    data = getattr(value, '__data__', None)
+    if data is None:
+        data = getattr(value, '__dict__', None)
+    if isinstance(data, dict):
+        size += sizeof(data)
+    return size
+
+
+class CacheBackend(object):
+    """ the interface every cache tier implements """
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def getStale(self, key, default=None):
+        # returns a tuple of the value and whether it has expired
+        # backends that drop entries as soon as they expire never have anything stale to return
+        return self.get(key, default), False
+
+    def set(self, key, value, expires=0):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    """ thread safe in memory LRU cache bounded by both number of entries and total bytes """
+
+    def __init__(self, max_size=CACHE_MAX_SIZE, max_bytes=CACHE_MAX_BYTES, max_item_bytes=CACHE_MAX_ITEM_BYTES):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejections = 0
+        # most recently used key is at the end, least is at the front
+        # an ordered dict makes moving and popping from either end constant time
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[2] and entry[2] <= time.monotonic():
+                self.delete(key)
+                self.expirations += 1
+                return default
+            self._entries.move_to_end(key)
+            entry[3] += 1
+            return entry[0]
+
+    def getStale(self, key, default=None):
+        # expired entries are kept here until they're replaced or evicted, so they can still be served
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default, False
+            self._entries.move_to_end(key)
+            entry[3] += 1
+            return entry[0], bool(entry[2] and entry[2] <= time.monotonic())
+
+    def set(self, key, value, expires=0):
+        # expires is in seconds from now, zero means never
+        expires_at = expires and time.monotonic() + expires or 0
+
+        size = sizeof(value)
+        if size > self.max_item_bytes:
+            # storing this would evict a lot of small, frequently used entries (like auths) to make room
+            self.rejections += 1
+            return False
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+            while self._entries and (len(self._entries) >= self.max_size or self.bytes + size > self.max_bytes):
+                self._evict()
+
+            # value, size, expires_at, hits
+            self._entries[key] = [value, size, expires_at, 0]
+            self.bytes += size
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+        return entry is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+            self.evictions = 0
+            self.expirations = 0
+            self.rejections = 0
+
+    def _evict(self):
+        # the caller must already hold the lock
+        key, entry = self._entries.popitem(last=False)
+        self.bytes -= entry[1]
+        self.evictions += 1
+        return key
+
+    def snapshot(self):
+        # a list of (key, size, hits) for every entry, for reporting
+        with self._lock:
+            return [(key, entry[1], entry[3]) for key, entry in self._entries.items()]
+
+
+class MemcacheBackend(CacheBackend):
+    """ shared cache tier that talks to memcached through a client like `memcache.Client` """
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key, default=None):
+        value = self.client.get(key)
+        if value is None:
+            return default
+        return value
+
+    def set(self, key, value, expires=0):
+        # NOTE: min_compress_len is an argument that can be sent here to compress the value
+        #       could be useful to save memory but unclear how it effects performance
+        return bool(self.client.set(key, value, time=expires, noreply=True))
+
+    def delete(self, key):
+        return bool(self.client.delete(key))
+
+    def clear(self):
+        self.client.flush_all()
+
+
+class TieredCache(CacheBackend):
+    """ read through cache with a fast per process L1 in front of a shared L2 """
+
+    def __init__(self, l1, l2, l1_expires=CACHE_L1_EXPIRES):
+        self.l1 = l1
+        self.l2 = l2
+        self.l1_expires = l1_expires
+
+    def get(self, key, default=None):
+        value = self.l1.get(key, _MISSING)
+        if value is _MISSING:
+            value = self.l2.get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            # we don't know how long the L2 has left on this, so only keep it locally for a short while
+            self.l1.set(key, value, expires=self.l1_expires)
+        return value
+
+    def set(self, key, value, expires=0):
+        self.l1.set(key, value, expires=min(expires or self.l1_expires, self.l1_expires))
+        return self.l2.set(key, value, expires=expires)
+
+    def delete(self, key):
+        self.l1.delete(key)
+        return self.l2.delete(key)
+
+    def clear(self):
+        self.l1.clear()
+        self.l2.clear()
+
+
+def makeCache(mcache=None):
+    if mcache:
+        return TieredCache(LRUCache(max_size=CACHE_L1_MAX_SIZE), MemcacheBackend(mcache))
+    return LRUCache()
+
+
+def keyPrefix(key):
+    # groups keys for reporting, e.g. all the `auth_` keys together and all the page paths together
+    if key.startswith('/'):
+        return '/'
+    if '_' in key:
+        return key.split('_', 1)[0] + '_'
+    return key
+
+
+class CacheStats(object):
+    """ lightweight counters for how well the cache is doing, they start over whenever the cache is cleared """
+
+    # NOTE: these are updated without a lock from executor threads too, so treat the numbers as approximate
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0 # misses that waited on another request rendering the same page
+        self.fills = 0
+        self.fill_seconds = 0.0
+        self.max_fill_seconds = 0.0
+        self.prefixes = {}
+
+    def prefix(self, key):
+        prefix = keyPrefix(key)
+        counts = self.prefixes.get(prefix)
+        if counts is None:
+            counts = self.prefixes[prefix] = {'hits': 0, 'misses': 0}
+        return counts
+
+    def hit(self, key):
+        self.hits += 1
+        self.prefix(key)['hits'] += 1
+
+    def miss(self, key):
+        self.misses += 1
+        self.prefix(key)['misses'] += 1
+
+    def fill(self, seconds):
+        self.fills += 1
+        self.fill_seconds += seconds
+        if seconds > self.max_fill_seconds:
+            self.max_fill_seconds = seconds
+
+    def toDict(self, top=10):
+        lookups = self.hits + self.misses
+        data = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': lookups and round(self.hits / lookups, 4) or 0,
+            'fills': self.fills,
+            'fill_ms_avg': self.fills and round(self.fill_seconds / self.fills * 1000, 2) or 0,
+            'fill_ms_max': round(self.max_fill_seconds * 1000, 2),
+        }
+
+        prefixes = {prefix: dict(counts, entries=0, bytes=0) for prefix, counts in self.prefixes.items()}
+
+        # only the part of the cache in this process can be inspected, memcache doesn't list its keys
+        local = localCache()
+        if isinstance(local, LRUCache):
+            entries = local.snapshot()
+            for key, size, hits in entries:
+                prefix = prefixes.setdefault(keyPrefix(key), {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0})
+                prefix['entries'] += 1
+                prefix['bytes'] += size
+
+            data.update({
+                'entries': len(entries),
+                'bytes': local.bytes,
+                'max_size': local.max_size,
+                'max_bytes': local.max_bytes,
+                'evictions': local.evictions,
+                'expirations': local.expirations,
+                'rejections': local.rejections,
+                'top_by_size': [{'key': key, 'bytes': size, 'hits': hits}
+                    for key, size, hits in sorted(entries, key=lambda e: e[1], reverse=True)[:top]],
+                'top_by_hits': [{'key': key, 'bytes': size, 'hits': hits}
+                    for key, size, hits in sorted(entries, key=lambda e: e[2], reverse=True)[:top]],
+            })
+
+        data['prefixes'] = prefixes
+        return data
+
+
+_MISSING = object()
+CACHE = makeCache(MCACHE)
+STATS = CacheStats()
+REVALIDATING = set() # keys with a background refresh in flight
+REVALIDATING_LOCK = threading.Lock()
+
+
+class CacheBus(object):
+    """ broadcasts uncache and clear_cache calls to every worker process with postgres LISTEN/NOTIFY """
+
+    LOGGER = logging.getLogger('tornado.application')
+
+    CHANNEL = 'cache_invalidation'
+    ORIGIN = str(os.getpid()) + '-' + uuid.uuid4().hex # so we can skip messages this process already applied
+    RECONNECT_DELAY = 5 # seconds
+
+    CONNECT = None
+    CONNECTION = None
+    LOCK = threading.Lock()
+
+    @classmethod
+    def start(cls, connect):
+        # connect is a function returning a new psycopg2 connection that is dedicated to the bus
+        cls.CONNECT = connect
+        try:
+            connection = connect()
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute('LISTEN ' + cls.CHANNEL)
+        except Exception:
+            cls.LOGGER.exception('Cache bus failed to connect.')
+            IOLoop.current().call_later(cls.RECONNECT_DELAY, cls.start, connect)
+            return
+
+        if cls.CONNECTION:
+            # we can't know what we missed while disconnected, so start fresh
+            localCache().clear()
+
+        cls.CONNECTION = connection
+        IOLoop.current().add_handler(connection.fileno(), cls.onReadable, IOLoop.READ)
+
+    @classmethod
+    def stop(cls):
+        connection = cls.CONNECTION
+        cls.CONNECTION = cls.CONNECT = None
+        if connection and not connection.closed:
+            IOLoop.current().remove_handler(connection.fileno())
+            connection.close()
+
+    @classmethod
+    def onReadable(cls, fd, events):
+        try:
+            with cls.LOCK:
+                cls.CONNECTION.poll()
+                notifies = list(cls.CONNECTION.notifies)
+                cls.CONNECTION.notifies.clear()
+        except Exception:
+            cls.LOGGER.exception('Cache bus lost its connection.')
+            IOLoop.current().remove_handler(fd)
+            try:
+                # a broken connection still holds its socket until it's closed
+                cls.CONNECTION.close()
+            except Exception:
+                pass
+            IOLoop.current().call_later(cls.RECONNECT_DELAY, cls.start, cls.CONNECT)
+            return
+
+        for notify in notifies:
+            cls.apply(notify.payload)
+
+    @classmethod
+    def apply(cls, payload):
+        message = json.loads(payload)
+        if message['origin'] == cls.ORIGIN:
+            return
+
+        # only this process' copy needs to change - a shared tier was already updated by the sender
+        if message['action'] == 'clear':
+            localCache().clear()
+        else:
+            localCache().delete(message['key'])
+
+    @classmethod
+    def publish(cls, action, key=None):
+        if not cls.CONNECTION:
+            return
+
+        payload = json.dumps({'origin': cls.ORIGIN, 'action': action, 'key': key})
+        try:
+            with cls.LOCK:
+                with cls.CONNECTION.cursor() as cursor:
+                    cursor.execute('SELECT pg_notify(%s, %s)', (cls.CHANNEL, payload))
+        except Exception:
+            # the other workers will catch up once the bus reconnects and they clear their caches
+            cls.LOGGER.exception('Cache bus failed to publish.')
+
+
+def localCache():
+    # the part of the cache that lives in this process
+    return getattr(CACHE, 'l1', CACHE)
 
 
 def natural_list(string_list):
@@ -102,8 +513,108 @@ def int_comma(i):
     return s + ','.join(reversed(groups))
 
 
+# matches tornado template expressions, directives, and comments
+TEMPLATE_TAG = re.compile(r'{{.*?}}|{%.*?%}|{#.*?#}', re.DOTALL)
+TEMPLATE_PLACEHOLDER = re.compile(r'trestletemplatetag(\d+)x')
+
+
+def minifyTemplate(source):
+    # template tags are swapped out for placeholders first so the minifier doesn't mangle them
+    # e.g. an expression used as an attribute would get its quotes escaped
+    # placeholders are lowercase because the parser lowercases attribute names
+    tags = []
+
+    def stash(match):
+        tags.append(match.group(0))
+        return 'trestletemplatetag' + str(len(tags) - 1) + 'x'
+
+    source = TEMPLATE_TAG.sub(stash, source)
+
+    # attribute quotes have to stay because a placeholder might render as something with spaces in it
+    source = htmlmin.minify(source, remove_comments=True, remove_empty_space=True,
+        remove_optional_attribute_quotes=False)
+
+    return TEMPLATE_PLACEHOLDER.sub(lambda match: tags[int(match.group(1))], source)
+
+
+class MinifiedLoader(template.Loader):
+    """ minifies templates once when they're compiled, so no response pays for it """
+
+    def _create_template(self, name):
+        path = os.path.join(self.root, name)
+        with open(path, 'rb') as f:
+            source = minifyTemplate(f.read().decode('utf-8'))
+        return template.Template(source, name=name, loader=self)
+
+
+class CachedPage(object):
+    """ a rendered page with everything needed to answer a request for it computed once up front """
+
+    __slots__ = ('status', 'content_type', 'body', 'gzipped', 'brotlied', 'etag')
+
+    def __init__(self, body, status=200, content_type=None):
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+        self.gzipped = gzip.compress(self.body, compresslevel=9)
+        self.brotlied = BROTLI and BROTLI.compress(self.body) or None
+        # a strong ETag computed the same way tornado does it, but only once
+        self.etag = hashlib.sha1(self.body).hexdigest()
+
+    def __getstate__(self):
+        # python-memcached pickles with protocol 0 by default, which needs this for a class with __slots__
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __sizeof__(self):
+        size = object.__sizeof__(self) + len(self.body) + len(self.gzipped) + len(self.etag)
+        if self.brotlied:
+            size += len(self.brotlied)
+        return size
+
+    def write(self, controller):
+        if self.content_type:
+            controller.set_header('Content-Type', self.content_type)
+        controller.set_status(self.status)
+
+        accept = controller.request.headers.get('Accept-Encoding', '')
+        if self.brotlied and 'br' in accept:
+            body, encoding = self.brotlied, 'br'
+        elif 'gzip' in accept:
+            body, encoding = self.gzipped, 'gzip'
+        else:
+            body, encoding = self.body, None
+
+        # when tornado compresses responses it adds this itself, and it leaves alone anything already encoded
+        if not controller.settings.get('compress_response'):
+            controller.add_header('Vary', 'Accept-Encoding')
+        if encoding:
+            controller.set_header('Content-Encoding', encoding)
+
+        if self.status == 200:
+            # every encoding is a different representation, so each one needs its own strong ETag
+            etag = self.etag
+            if encoding:
+                etag += '-' + encoding
+            controller.set_header('Etag', '"' + etag + '"')
+
+            # tornado skips its own ETag handling once the header is set, so we check it here
+            if controller.check_etag_header():
+                controller.set_status(304)
+                return
+
+        controller.write(body)
+
+
+# pages currently being rendered for the cache, so concurrent requests for the same key can wait on them
+RENDERING = {}
+
+
 # decorator to skip straight to the cached version, or cache it if it doesn't exist
-def cacheAndRender(skip_check=None, content_type=None):
+def cacheAndRender(skip_check=None, content_type=None, expires=0):
 
     def wrap_action(action):
         async def decorate(*args, **kwargs):
@@ -111,81 +622,125 @@ def cacheAndRender(skip_check=None, content_type=None):
 
             # if we're checking for errors and they're present, then return early to avoid caching
             if skip_check and skip_check(controller):
-                return action(*args, **kwargs)
+                return await action(*args, **kwargs)
+
+            key = cacheKey(controller.request.path + controller.request.query)
+            page = CACHE.get(key)
 
-            key = controller.request.path + controller.request.query
-            html = CACHE.get(key)
+            while not page and key in RENDERING:
+                # another request is already rendering this page, so wait for it instead of doing the same work
+                # if that doesn't end with a page it resolves to None, and the first waiter to wake up renders it
+                # while any others go back to waiting, this time for that one
+                STATS.coalesced += 1
+                page = await RENDERING[key]
 
-            if html:
+            if page:
                 # the action wasn't ever called, so explicitly render the output here
-                if content_type:
-                    controller.set_header('Content-Type', content_type)
-                controller.write(html)
+                STATS.hit(key)
+                page.write(controller)
             else:
-                await action(*args, **kwargs)
-                html = b"".join(controller._write_buffer).decode()
-
-                remove_quotes = content_type != 'application/xml'
-
-                html = htmlmin.minify(html, remove_comments=True, remove_empty_space=True,
-                    remove_optional_attribute_quotes=remove_quotes)
-
-                if not controller.debug:
-                    cache(key, lambda: html)
-
+                STATS.miss(key)
+                start = time.perf_counter()
+                # HEAD requests don't render a body, so there's nothing to cache
+                cacheable = not controller.debug and controller.request.method == 'GET'
+                rendering = None
+                if cacheable:
+                    rendering = RENDERING[key] = Future()
+
+                try:
+                    await action(*args, **kwargs)
+
+                    # only cache pages that rendered normally or as not found, never redirects or errors
+                    if cacheable and controller.get_status() in (200, 404):
+                        # the templates were already minified when they were compiled (see `MinifiedLoader`)
+                        body = b"".join(controller._write_buffer)
+                        page = CachedPage(body, status=controller.get_status(), content_type=content_type)
+                        STATS.fill(time.perf_counter() - start)
+                        CACHE.set(key, page, expires=expires)
+
+                        # send the same precompressed version that later requests will get
+                        controller._write_buffer = []
+                        page.write(controller)
+                finally:
+                    if rendering:
+                        if RENDERING.get(key) is rendering:
+                            del RENDERING[key]
+                        rendering.set_result(page)
+
+        # lets startup find these actions to warm the cache (see `warmCache` in main.py)
+        decorate.cacheAndRender = True
         return decorate
     return wrap_action
 
 
-def cache(key, function, expires=0, debug=False):
+def cacheKey(key):
     # make the key memcache compatible
-    key = key.replace(' ', '_')[:250]
+    return key.replace(' ', '_')[:250]
 
-    if MCACHE:
-        value = CACHE.get(key)
-        if value is None:
-            value = function()
-            if not debug:
-                # NOTE: min_compress_len is an argument that can be sent here to compress the value
-                #       could be useful to save memory but unclear how it effects performance
-                CACHE.set(key, value, time=expires, noreply=True)
-    else:
-        assert not expires, 'Setting an expires time is only compatible with memcache, not the LRU'
 
-        # simple in memory LRU cache, most recently used key is moved to the end, least is at front
-        if key in CACHE:
-            # move the key to the end since it was just used
-            # (this method avoids a temporary state with the key not existing that might not be threadsafe)
-            CACHE_KEYS.sort(key=key.__eq__)
-            return CACHE[key]
+# with `revalidate` an expired value is returned right away while a single refresh runs in the background
+# NOTE: that refresh happens in an executor thread after the request may have finished
+#       so a function that queries the database needs to manage its own connection, e.g. with `model.threaded_db`
+def cache(key, function, expires=0, debug=False, revalidate=False):
+    assert expires or not revalidate, 'Revalidating requires an expires time'
+    key = cacheKey(key)
 
-        while len(CACHE_KEYS) >= CACHE_MAX_SIZE:
-            remove_key = CACHE_KEYS.pop(0)
-            del CACHE[remove_key]
+    # sentinel so that falsy values can still be cached
+    if revalidate:
+        value, stale = CACHE.getStale(key, _MISSING)
+        if stale and not revalidateLater(key, function, expires):
+            value = _MISSING
+    else:
+        value = CACHE.get(key, _MISSING)
 
+    if value is _MISSING:
+        STATS.miss(key)
+        start = time.perf_counter()
         value = function()
-        if key not in CACHE and not debug:
-            CACHE[key] = value
-            CACHE_KEYS.append(key)
+        STATS.fill(time.perf_counter() - start)
+        if not debug:
+            CACHE.set(key, value, expires=expires)
+    else:
+        STATS.hit(key)
 
     return value
 
 
-def uncache(key):
-    # make the key memcache compatible
-    key = key.replace(' ', '_')[:250]
+def revalidateLater(key, function, expires):
+    # returns whether a refresh is scheduled, without a running loop the caller has to refresh inline instead
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    loop = IOLoop.current()
 
-    if MCACHE:
-        MCACHE.delete(key)
-    elif key in CACHE:
-        del CACHE[key]
-        CACHE_KEYS.remove(key)
+    with REVALIDATING_LOCK:
+        if key in REVALIDATING:
+            return True
+        REVALIDATING.add(key)
+
+    async def refresh():
+        try:
+            value = await IOLoop.current().run_in_executor(None, function)
+            CACHE.set(key, value, expires=expires)
+        except Exception:
+            # the stale value stays in place, so the next request will try again
+            logging.getLogger('tornado.application').exception('Revalidating cache key failed: ' + key)
+        finally:
+            with REVALIDATING_LOCK:
+                REVALIDATING.discard(key)
+
+    loop.add_callback(refresh)
+    return True
+
+
+def uncache(key):
+    key = cacheKey(key)
+    CACHE.delete(key)
+    CacheBus.publish('delete', key)
 
 
 def clear_cache():
-    if MCACHE:
-        MCACHE.flush_all()
-    else:
-        global CACHE, CACHE_KEYS
-        CACHE = {}
-        CACHE_KEYS = []
+    CACHE.clear()
+    STATS.reset()
+    CacheBus.publish('clear')
@@ -2,14 +2,19 @@
 from http.cookies import Morsel
 import logging
 import os
+import re
+import time
 
-from tornado import web
+from tornado import httputil, web
+from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
 from tornado.log import enable_pretty_logging
 from tornado.options import define, options
 
 from config import constants
 from cron import Cron
+import helpers
+import model
 from tasks import TaskConsumer
 
 # URL routes
@@ -88,7 +93,8 @@ def makeApp(domain=None, debug=False, autoreload=False, level=logging.INFO):
     if not domain:
         domain = constants.HOST
 
-    return webApp(handlers=handlers, template_path=views_path, debug=debug, autoreload=autoreload,
+    return webApp(handlers=handlers, template_path=views_path, template_loader=helpers.MinifiedLoader(views_path),
+        debug=debug, autoreload=autoreload,
         compress_response=True,
         static_path=static_path, static_handler_class=static.StaticFileController,
         cookie_secret=constants.SESSION_KEY, xsrf_cookies=True,
@@ -96,6 +102,58 @@ def makeApp(domain=None, debug=False, autoreload=False, level=logging.INFO):
         login_url='/account/login')
 
 
+class WarmupContext(object):
+    remote_ip = '127.0.0.1'
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+
+class WarmupConnection(httputil.HTTPConnection):
+    """ stands in for a client connection so the app can render a request without any network involved """
+
+    def __init__(self, protocol):
+        self.context = WarmupContext(protocol)
+        self.finished = Future()
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write_headers(self, start_line, headers, chunk=None, callback=None):
+        return self.write(chunk)
+
+    def write(self, chunk, callback=None):
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def finish(self):
+        self.finished.set_result(None)
+
+
+async def warmCache(app, domain=None, protocol='https'):
+    # render every page that gets cached and doesn't depend on the path
+    # so the first real visitors after a restart don't pay for compiling, rendering, and minifying
+    start = time.perf_counter()
+    total = 0
+
+    for pattern, handler in handlers:
+        action = getattr(handler, 'get', None)
+        if not getattr(action, 'cacheAndRender', False) or re.compile(pattern).groups:
+            continue
+
+        headers = httputil.HTTPHeaders({'Host': domain or constants.HOST, 'User-Agent': 'Warmup'})
+        connection = WarmupConnection(protocol)
+        request = httputil.HTTPServerRequest(method='GET', uri=pattern, headers=headers, connection=connection)
+        app(request)
+        await connection.finished
+        total += 1
+
+    duration = (time.perf_counter() - start) * 1000
+    logging.getLogger('tornado.access').info('Cache warm up of %d pages took %.1f ms' % (total, duration))
+    return total
+
+
 # see https://www.tornadoweb.org/en/stable/guide/running.html
 if __name__ == "__main__":
     define('debug', default=False, help='enable debug')
@@ -107,9 +165,21 @@ if __name__ == "__main__":
 
     options.parse_command_line()
 
+    # before anything else so that there aren't any other threads yet when the password processes are forked
+    model.Passwords.start()
+
     # FUTURE: this should probably be run in a separate process, especially in production
     IOLoop.current().add_callback(TaskConsumer.consumer, debug=options.debug)
 
+    # keeps the cache in this process in sync with uncache and clear_cache calls from the other workers
+    IOLoop.current().add_callback(helpers.CacheBus.start, model.newConnection)
+
+    # writes when each auth was last used every few seconds, rather than on every request
+    IOLoop.current().add_callback(model.AuthTouches.start)
+
+    # checks how far behind the replica is every few seconds, so requests never wait on it to find out
+    IOLoop.current().add_callback(model.Replica.start)
+
     # CAREFUL only run this during development - supervisor should run this separately in production
     if options.debug:
         IOLoop.current().add_callback(Cron.setup, debug=options.debug)
@@ -119,6 +189,11 @@ if __name__ == "__main__":
     else:
         app = makeApp()
 
+        model.warmPool()
+
+        # nothing is cached in debug mode, so there's only something to warm up in production
+        IOLoop.current().run_sync(lambda: warmCache(app))
+
     # xheaders enables forwarded headers from nginx
     app.listen(options.port, address=options.address, xheaders=True)
 
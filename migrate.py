@@ -0,0 +1,189 @@
+from datetime import datetime, timedelta
+import logging
+import time
+
+from tornado.options import define, options
+
+import model
+
+
+# the tables to keep indexes in sync for, in dependency order
+MODELS = [model.Migration, model.Account, model.Auth, model.SessionData]
+
+
+def partitionAuth():
+    # converts an auth table from before it was partitioned, keeping only the auths that haven't expired yet
+    # WARNING! this locks the auth table while the recent rows are copied, so run it when traffic is low
+    row = model.peewee_db.execute_sql("SELECT relkind FROM pg_class WHERE oid = to_regclass('auth')").fetchone()
+    if not row or row[0] == 'p':
+        # new databases are created partitioned
+        return
+
+    from cron import AuthCron
+    cutoff = datetime.utcnow() - timedelta(AuthCron.MAX_DAYS)
+
+    with model.peewee_db.atomic():
+        # move the old table and everything named after it out of the way of the new one
+        model.peewee_db.execute_sql('ALTER TABLE "auth" RENAME TO "auth_unpartitioned"')
+        model.peewee_db.execute_sql('ALTER SEQUENCE "auth_id_seq" RENAME TO "auth_unpartitioned_id_seq"')
+        for name in existingIndexes(model.peewee_db.cursor(), 'auth_unpartitioned'):
+            new_name = name.replace('auth', 'auth_unpartitioned', 1)
+            model.peewee_db.execute_sql('ALTER INDEX "' + name + '" RENAME TO "' + new_name + '"')
+
+        model.Auth.create_table()
+
+        columns = ', '.join('"' + field.column_name + '"' for field in model.Auth._meta.sorted_fields)
+        sql = 'INSERT INTO "auth" (' + columns + ') SELECT ' + columns + ' FROM "auth_unpartitioned"'
+        model.peewee_db.execute_sql(sql + ' WHERE "modified_dt" >= %s', (cutoff,))
+        model.peewee_db.execute_sql("SELECT setval('auth_id_seq', "
+            "(SELECT COALESCE(MAX(id), 0) + 1 FROM auth_unpartitioned), false)")
+        model.peewee_db.execute_sql('DROP TABLE "auth_unpartitioned"')
+
+
+# one time data or schema changes, each is run once in order and then recorded in the migration table
+# add new ones to the end as `(name, function)` where the function takes no arguments and uses `model.peewee_db`
+# so it can use `atomic()` for anything that has to happen together
+# NOTE: keep each one idempotent and batched - they run against the live database while the app is serving requests
+MIGRATIONS = [
+    ('0001_partition_auth', partitionAuth),
+]
+
+
+def indexSQL(index):
+    # peewee renders model indexes as `CREATE [UNIQUE] INDEX IF NOT EXISTS "name" ON "table" (...)`
+    # building concurrently doesn't take a lock that blocks writes, so the app can keep running during a migration
+    sql, params = model.peewee_db.get_sql_context().sql(index.safe(True)).query()
+    return sql.replace(' INDEX IF NOT EXISTS ', ' INDEX CONCURRENTLY IF NOT EXISTS ', 1), params
+
+
+def invalidIndexes(cursor):
+    # a concurrent build that fails (e.g. a unique violation or a cancelled deploy) leaves an invalid index behind
+    # that postgres still has to maintain on writes but never uses for reads, so it has to be dropped and rebuilt
+    cursor.execute('SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+        'JOIN pg_namespace n ON n.oid = c.relnamespace WHERE NOT i.indisvalid AND n.nspname = current_schema()')
+    return set(row[0] for row in cursor.fetchall())
+
+
+def existingIndexes(cursor, table):
+    # NOTE: peewee's `get_indexes` only looks at regular tables, so it doesn't see a partitioned table's indexes
+    cursor.execute('SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s', (table,))
+    return set(row[0] for row in cursor.fetchall())
+
+
+def buildPartitionedIndex(cursor, cls, index, sql, params):
+    # a partitioned table can't build an index concurrently, so build one concurrently on each partition instead
+    # then create the parent index on only the partitioned table itself (which is instant) and attach them to it
+    # the parent stays invalid until every partition is attached, so an interrupted build gets redone next time
+    name = index._name
+    table = cls._meta.table_name
+    parent_sql = sql.replace(' CONCURRENTLY IF NOT EXISTS ', ' IF NOT EXISTS ', 1)
+    parent_sql = parent_sql.replace(' ON "' + table + '" ', ' ON ONLY "' + table + '" ', 1)
+    cursor.execute(parent_sql, params)
+
+    for partition in cls.partitions():
+        partition_name = name + '_' + partition
+        partition_sql = sql.replace('"' + name + '"', '"' + partition_name + '"', 1)
+        partition_sql = partition_sql.replace(' ON "' + table + '" ', ' ON "' + partition + '" ', 1)
+        cursor.execute(partition_sql, params)
+        cursor.execute('ALTER INDEX "' + name + '" ATTACH PARTITION "' + partition_name + '"')
+
+
+def syncIndexes(connection, dry_run=False):
+    """ creates any indexes declared on the models that are missing from the database """
+    created = []
+    cursor = connection.cursor()
+    invalid = invalidIndexes(cursor)
+
+    for cls in MODELS:
+        table = cls._meta.table_name
+        existing = existingIndexes(cursor, table)
+        partitioned = bool(cls.partitions())
+
+        for index in cls._meta.fields_to_index():
+            name = index._name
+            if name in existing and name not in invalid:
+                continue
+
+            sql, params = indexSQL(index)
+            logging.info(('Would create' if dry_run else 'Creating') + ' index ' + name + ' on ' + table)
+            if not dry_run:
+                start = time.time()
+                if partitioned:
+                    if name in invalid:
+                        # dropping concurrently isn't supported either, but this only removes an unused index
+                        cursor.execute('DROP INDEX IF EXISTS "' + name + '"')
+                    buildPartitionedIndex(cursor, cls, index, sql, params)
+                else:
+                    if name in invalid:
+                        cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS "' + name + '"')
+                    cursor.execute(sql, params)
+                logging.info('Created index ' + name + ' in ' + str(round(time.time() - start, 3)) + 's')
+            created.append(name)
+
+    cursor.close()
+    return created
+
+
+def runMigrations(migrations=None, dry_run=False):
+    """ runs any one time migrations that haven't been recorded yet """
+    if migrations is None:
+        migrations = MIGRATIONS
+
+    done = set()
+    if model.Migration.table_exists():
+        done = set(m.name for m in model.Migration.select(model.Migration.name))
+
+    ran = []
+    for name, function in migrations:
+        if name in done:
+            continue
+
+        logging.info(('Would run' if dry_run else 'Running') + ' migration ' + name)
+        if not dry_run:
+            start = time.time()
+            function()
+            model.Migration.create(name=name)
+            logging.info('Finished migration ' + name + ' in ' + str(round(time.time() - start, 3)) + 's')
+        ran.append(name)
+
+    return ran
+
+
+def migrate(dry_run=False, migrations=False):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction block, so use a dedicated autocommit connection
+    # rather than one from the pool, which would wrap it in peewee's transaction handling
+    connection = model.newConnection()
+    connection.autocommit = True
+
+    try:
+        if not dry_run:
+            # brand new tables are empty, so creating them along with their indexes doesn't block anything
+            # but existing ones are left alone, because `create_table` would build their indexes without CONCURRENTLY
+            for cls in MODELS:
+                if not cls.table_exists():
+                    cls.create_table()
+        # migrations first, as one might replace a table, which would waste building indexes on the old one
+        # but only when asked for, because some lock tables while they run, so they're not left to every deploy
+        if migrations:
+            ran = runMigrations(dry_run=dry_run)
+        else:
+            ran = []
+            for name in runMigrations(dry_run=True):
+                logging.warning('Skipped migration ' + name + ', run it with --migrations when traffic is low')
+        created = syncIndexes(connection, dry_run=dry_run)
+    finally:
+        connection.close()
+        model.peewee_db.close()
+
+    return created, ran
+
+
+if __name__ == '__main__':
+    define('dry_run', default=False, help='only log what would be done')
+    define('migrations', default=False, help='also run one time migrations, which may lock tables')
+
+    options.parse_command_line()
+
+    created, ran = migrate(dry_run=options.dry_run, migrations=options.migrations)
+
+    logging.info('Migration finished. ' + str(len(created)) + ' indexes, ' + str(len(ran)) + ' migrations.')
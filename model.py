@@ -1,16 +1,323 @@
+import asyncio
 import base64
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextvars
+from functools import partial
 import os
-from datetime import datetime
-from hashlib import sha512
+from datetime import date, datetime, timedelta
+from hashlib import scrypt, sha512
+from hmac import compare_digest
+import logging
+import re
+import threading
+import time
+import weakref
 
-from peewee import (PostgresqlDatabase, BooleanField, CharField, DateTimeField,
-    ForeignKeyField, Model, DoesNotExist) # TextField
-from tornado.ioloop import IOLoop
+import psycopg2
+from peewee import (AutoField, BlobField, BooleanField, CharField, DateTimeField, ForeignKeyField, Model, DoesNotExist,
+    Entity, InterfaceError, NodeList, OperationalError, SENTINEL, SQL) # TextField
+from playhouse.pool import MaxConnectionsExceeded, PooledPostgresqlDatabase
+from tornado.ioloop import IOLoop, PeriodicCallback
 
 from config import constants
 
-peewee_db = PostgresqlDatabase(constants.DB_NAME, user=constants.DB_USER, password=constants.DB_PASS,
-    host=constants.DB_HOST, port=constants.DB_PORT, sslmode=constants.DB_SSLMODE, autoconnect=False)
+# uncomment to run the hot queries in `AsyncDB` natively with asyncpg, otherwise they fall back to `async_db`
+# import asyncpg
+
+# comment out to enable asyncpg
+asyncpg = None
+
+# where the current request's reads go, see `Replica` - this is None outside of requests so everything uses the primary
+# NOTE: each request runs in its own asyncio task, which gets its own copy of this, so concurrent requests don't mix
+ROUTE = contextvars.ContextVar('route', default=None)
+
+
+class Route(object):
+    """ whether the current request may read from the replica, whether it has written anything yet,
+        and which connections it has borrowed from the pools """
+
+    __slots__ = ('replica', 'wrote', 'borrowed')
+
+    def __init__(self, replica=False):
+        self.replica = replica
+        self.wrote = False
+        self.borrowed = set() # (database, thread id)
+
+    def release(self):
+        # hands back the connections this request borrowed in this thread, see `BaseController.releaseConnection`
+        # NOTE: peewee keeps one connection per thread, so requests running on the IOLoop thread share it
+        #       and one that happened to borrow it closing it at the end is fine, another one that's still using it
+        #       simply borrows again with its next query - but one that didn't borrow it mustn't close it
+        thread_id = threading.get_ident()
+        for database, borrowed_by in list(self.borrowed):
+            if borrowed_by == thread_id:
+                self.borrowed.discard((database, borrowed_by))
+                if not database.is_closed():
+                    database.close()
+
+
+# the queries run by the current request, see `QueryStats` - like `ROUTE` this is None outside of requests
+QUERIES = contextvars.ContextVar('queries', default=None)
+
+
+class QueryStats(object):
+    """ how many queries a request ran, how long they took, and how often it ran each one """
+
+    __slots__ = ('count', 'seconds', 'shapes')
+
+    # a list of parameters like `IN (%s, %s, %s)` varies with its length, so those are all counted as one shape
+    PARAMS_LIST = re.compile(r'%s(?:, %s)+')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = {}
+
+    @classmethod
+    def start(cls):
+        # called at the start of each request, see `BaseController.prepare`
+        stats = cls()
+        QUERIES.set(stats)
+        return stats
+
+    def record(self, sql, seconds):
+        self.count += 1
+        self.seconds += seconds
+        # peewee always passes values as parameters, so the sql itself is already the shape of the query
+        shape = self.PARAMS_LIST.sub('%s...', sql)
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+    def repeated(self, limit=None):
+        # queries run more than `limit` times, which usually means a query in a loop that should be a join
+        if limit is None:
+            limit = constants.DB_QUERY_REPEAT_WARNING
+        return [(shape, count) for shape, count in self.shapes.items() if count > limit]
+
+    def serverTiming(self):
+        # for the Server-Timing header, so the numbers show up in the browser's dev tools
+        return 'db;dur=' + str(round(self.seconds * 1000, 2)) + ';desc="' + str(self.count) + ' queries"'
+
+
+# the rows the current request has already loaded, see `IdentityMap` - like `ROUTE` this is None outside of requests
+IDENTITIES = contextvars.ContextVar('identities', default=None)
+
+
+class IdentityMap(object):
+    """ the one instance of each row loaded by the current request, so the same row is never fetched twice """
+
+    # NOTE: this only knows about rows loaded and saved through the model methods below
+    #       so a bulk `update()` or `delete()` query during the request won't be reflected in it
+
+    __slots__ = ('rows',)
+
+    def __init__(self):
+        self.rows = {}
+
+    @classmethod
+    def start(cls):
+        # called at the start of each request, see `BaseController.prepare`
+        identities = cls()
+        IDENTITIES.set(identities)
+        return identities
+
+    @classmethod
+    def get(cls, model_class, slug):
+        identities = IDENTITIES.get()
+        if identities is None:
+            return None
+        return identities.rows.get((model_class, str(slug)))
+
+    @classmethod
+    def add(cls, instance, replace=False):
+        # returns the instance the request should use, which is the one loaded first unless this replaces it
+        identities = IDENTITIES.get()
+        if identities is None or instance is None:
+            return instance
+        key = (type(instance), instance.slug)
+        if replace:
+            identities.rows[key] = instance
+            return instance
+        return identities.rows.setdefault(key, instance)
+
+    @classmethod
+    def remove(cls, model_class, slug):
+        identities = IDENTITIES.get()
+        if identities is not None:
+            identities.rows.pop((model_class, str(slug)), None)
+
+
+class InstrumentedDatabase(PooledPostgresqlDatabase):
+    """ records how long every query takes against the current request """
+
+    def connect(self, reuse_if_open=False):
+        opened = super().connect(reuse_if_open)
+        route = ROUTE.get()
+        if opened and route is not None:
+            route.borrowed.add((self, threading.get_ident()))
+        return opened
+
+    def execute_sql(self, sql, params=None, commit=SENTINEL):
+        stats = QUERIES.get()
+        if stats is None:
+            return super().execute_sql(sql, params, commit)
+
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, commit)
+        finally:
+            stats.record(sql, time.perf_counter() - start)
+
+
+class PrimaryDatabase(InstrumentedDatabase):
+    """ the database that all writes go to, which notes them so the rest of the request reads its own writes """
+
+    def execute_sql(self, sql, params=None, commit=SENTINEL):
+        route = ROUTE.get()
+        if route is not None and not route.wrote and not sql.lstrip()[:6].upper() == 'SELECT':
+            route.wrote = True
+        return super().execute_sql(sql, params, commit)
+
+
+class ReplicaDatabase(InstrumentedDatabase):
+    """ a read only copy of the primary that falls back to it whenever there's a problem """
+
+    def execute_sql(self, sql, params=None, commit=SENTINEL):
+        try:
+            return super().execute_sql(sql, params, commit)
+        except (InterfaceError, OperationalError, MaxConnectionsExceeded) as e:
+            # this includes hot standby errors like queries being cancelled because of a conflict with recovery
+            Replica.failed(e)
+            return peewee_db.execute_sql(sql, params, commit)
+
+
+# connect and close borrow and return connections from the pool rather than opening new ones every time
+# autoconnect means the first query borrows a connection, so anything that never queries never connects
+peewee_db = PrimaryDatabase(constants.DB_NAME, user=constants.DB_USER, password=constants.DB_PASS,
+    host=constants.DB_HOST, port=constants.DB_PORT, sslmode=constants.DB_SSLMODE, autoconnect=True,
+    max_connections=constants.DB_MAX_CONNECTIONS, stale_timeout=constants.DB_STALE_TIMEOUT)
+
+
+def makeReplica(host):
+    if not host:
+        return None
+
+    # a short connect timeout so an unreachable replica doesn't hold up a request or the lag check for long
+    return ReplicaDatabase(constants.DB_NAME, user=constants.DB_USER, password=constants.DB_PASS,
+        host=host, port=constants.DB_REPLICA_PORT, sslmode=constants.DB_SSLMODE, autoconnect=True,
+        max_connections=constants.DB_MAX_CONNECTIONS, stale_timeout=constants.DB_STALE_TIMEOUT,
+        connect_timeout=constants.DB_REPLICA_CONNECT_TIMEOUT)
+
+
+replica_db = makeReplica(constants.DB_REPLICA_HOST)
+
+
+class Replica(object):
+    """ routes plain selects in read only requests to the replica while it's up and caught up with the primary """
+
+    CHECK_SECONDS = 5 # how often the lag is checked, in the background so requests never wait on it
+    RETRY_SECONDS = 30 # how long to stay on the primary after the replica fails
+    # how long a browser keeps reading from the primary after a request that wrote, so it sees its own changes
+    # this needs to be longer than the max lag plus the time between checks
+    STICKY_SECONDS = 10
+
+    # the replica is caught up if it has replayed everything it has received, otherwise it's behind by however
+    # long ago the last replayed transaction was - and on a server that isn't a replica this is null
+    LAG_SQL = ('SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+        'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END')
+
+    healthy = False
+    lag = None
+    checked_at = 0
+    check_after = 0
+    lock = threading.Lock()
+    callback = None
+
+    @classmethod
+    def route(cls, replica=False):
+        # called at the start of each request, see `BaseController.prepare`
+        route = Route(replica=replica and replica_db is not None)
+        ROUTE.set(route)
+        return route
+
+    @classmethod
+    def database(cls):
+        # which database a select should run against right now
+        route = ROUTE.get()
+        if route is None or not route.replica or route.wrote or peewee_db.in_transaction():
+            return peewee_db
+        return cls.available() and replica_db or peewee_db
+
+    @classmethod
+    def available(cls):
+        # only trusts a recent check, in case the checks have stopped getting through, e.g. the executor is full
+        return cls.healthy and time.monotonic() - cls.checked_at < cls.CHECK_SECONDS * 2
+
+    @classmethod
+    def start(cls):
+        # called once per process by `main.py`, until the first check finishes everything reads from the primary
+        if replica_db is not None and cls.callback is None:
+            cls.callback = PeriodicCallback(cls.checkLater, cls.CHECK_SECONDS * 1000)
+            cls.callback.start()
+            IOLoop.current().add_callback(cls.checkLater)
+
+    @classmethod
+    async def checkLater(cls):
+        if time.monotonic() < cls.check_after:
+            return
+        try:
+            await async_db(cls.check)
+        except DatabaseBusy:
+            # the previous result stands until it's too old to trust
+            pass
+
+    @classmethod
+    def check(cls):
+        # only one check at a time, an unreachable replica can take a while to time out
+        if not cls.lock.acquire(blocking=False):
+            return
+        try:
+            # skip the fallback to the primary here, which would always look caught up
+            lag = PooledPostgresqlDatabase.execute_sql(replica_db, cls.LAG_SQL).fetchone()[0]
+        except (InterfaceError, OperationalError, MaxConnectionsExceeded) as e:
+            cls.failed(e)
+            return
+        finally:
+            cls.lock.release()
+
+        cls.lag = lag and float(lag) or 0.0
+        cls.healthy = cls.lag <= constants.DB_REPLICA_MAX_LAG
+        cls.checked_at = time.monotonic()
+        if not cls.healthy:
+            logging.warning('Replica is ' + str(round(cls.lag, 3)) + 's behind, reading from the primary.')
+
+    @classmethod
+    def failed(cls, error):
+        logging.warning('Replica unavailable, reading from the primary: ' + str(error))
+        cls.healthy = False
+        cls.check_after = time.monotonic() + cls.RETRY_SECONDS
+        try:
+            replica_db.close()
+        except Exception:
+            # the connection is already broken, which means it won't go back into the pool anyway
+            pass
+
+    @classmethod
+    def toDict(cls):
+        return {'enabled': replica_db is not None, 'healthy': cls.healthy, 'lag': cls.lag}
+
+
+def warmPool(size=constants.DB_POOL_WARM):
+    # open connections ahead of time so the first requests after a restart don't pay for connecting
+    # these go straight back into the pool rather than being held by this thread
+    with peewee_db._lock:
+        connections = [peewee_db._connect() for i in range(size)]
+        for connection in connections:
+            peewee_db._close(connection)
+
+
+def newConnection():
+    # a raw connection outside of peewee's management, for things like LISTEN that need one to themselves
+    return psycopg2.connect(database=peewee_db.database, **peewee_db.connect_params)
 
 
 # NOTE: database functions are synchronous, so we have to run them in another thread to make them asynchronous
@@ -19,20 +326,205 @@ peewee_db = PostgresqlDatabase(constants.DB_NAME, user=constants.DB_USER, passwo
 def threaded_db(func, *args):
     result = None
     with peewee_db.connection_context():
-        result = func(*args)
+        try:
+            result = func(*args)
+        finally:
+            if replica_db is not None and not replica_db.is_closed():
+                replica_db.close()
     return result
 
 
+class DatabaseBusy(Exception):
+    """ raised instead of queueing more database work when too much is already waiting """
+
+
+class DatabaseExecutor(object):
+    """ a thread pool just for database work, with a limit on how much can be waiting and timing metrics """
+
+    def __init__(self, max_workers=constants.DB_EXECUTOR_THREADS, max_queue=constants.DB_EXECUTOR_QUEUE):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+        self.lock = threading.Lock()
+        self.pending = 0 # both waiting and running
+        self.reset()
+
+    def reset(self):
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.run_seconds = 0.0
+        self.max_run_seconds = 0.0
+
+    async def run(self, func, *args):
+        with self.lock:
+            if self.pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise DatabaseBusy('Database executor is full: ' + str(self.pending) + ' calls are already pending.')
+            self.pending += 1
+            self.submitted += 1
+
+        queued_at = time.perf_counter()
+
+        def timed():
+            started_at = time.perf_counter()
+            try:
+                return threaded_db(func, *args)
+            finally:
+                finished_at = time.perf_counter()
+                with self.lock:
+                    self.pending -= 1
+                    self.completed += 1
+                    self.wait_seconds += started_at - queued_at
+                    self.max_wait_seconds = max(self.max_wait_seconds, started_at - queued_at)
+                    self.run_seconds += finished_at - started_at
+                    self.max_run_seconds = max(self.max_run_seconds, finished_at - started_at)
+
+        # run in a copy of this context so the work is routed like the rest of the request (see `Replica`)
+        context = contextvars.copy_context()
+        return await IOLoop.current().run_in_executor(self.executor, context.run, timed)
+
+    def toDict(self):
+        completed = self.completed
+        return {
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'pending': self.pending,
+            'queued': max(0, self.pending - self.max_workers),
+            'submitted': self.submitted,
+            'completed': completed,
+            'rejected': self.rejected,
+            'wait_ms_avg': completed and round(self.wait_seconds / completed * 1000, 2) or 0,
+            'wait_ms_max': round(self.max_wait_seconds * 1000, 2),
+            'run_ms_avg': completed and round(self.run_seconds / completed * 1000, 2) or 0,
+            'run_ms_max': round(self.max_run_seconds * 1000, 2),
+        }
+
+
+DB_EXECUTOR = DatabaseExecutor()
+
+
 # example use: async_db(list, Account.select()) or async_db(Account.select().count)
+# raises DatabaseBusy if too much work is already waiting, which gets turned into a 503 for requests
 async def async_db(func, *args):
-    result = await IOLoop.current().run_in_executor(None, threaded_db, func, *args)
-    # NOTE: peewee is supposed to store connections per thread
-    # and while you get an error about it not being open every time, it also looks like
-    # closing the connection in the child can also close it in the main thread
-    # so we check and re-open if needed - this assumes the connection is closed elsewhere (end of request)
-    if peewee_db.is_closed():
-        peewee_db.connect()
-    return result
+    # NOTE: peewee stores connections per thread, so this borrows a separate one from the pool
+    # and if anything closes the connection in this thread the next query here simply borrows another
+    return await DB_EXECUTOR.run(func, *args)
+
+
+class Prepared(object):
+    """ hot queries that each pooled connection plans once with PREPARE and from then on only executes """
+
+    # NOTE: prepared statements belong to a database session, so this won't work behind a pooler like pgbouncer
+    #       in transaction mode, and asyncpg doesn't need it because it already prepares and caches everything
+
+    # name: (model class, prepare sql, execute sql)
+    STATEMENTS = {}
+
+    # connection: set of statement names that have been prepared on it
+    # connections are recycled by the pool rather than recreated, so this usually fills up once per connection
+    PREPARED = weakref.WeakKeyDictionary()
+
+    PARAM = re.compile(r'\$(\d+)')
+
+    @classmethod
+    def register(cls, name, model_class, where, join=None):
+        # parameters use the postgres style of $1, $2, etc., and their types are inferred from the query
+        # NOTE: columns are listed rather than using `*` so adding one to the table doesn't change the result type
+        # of statements already prepared by running processes, which postgres refuses to execute
+        table = model_class._meta.table_name
+        if join:
+            # `join` is the name of a foreign key, whose row comes back in the same query as `<join>__<column>`
+            # columns have to include their table to not be ambiguous, and so does `where`
+            rel_model = model_class._meta.fields[join].rel_model
+            rel_table = rel_model._meta.table_name
+            columns = ['"' + table + '"."' + field.column_name + '"' for field in model_class._meta.sorted_fields]
+            for field in rel_model._meta.sorted_fields:
+                alias = join + '__' + field.column_name
+                columns.append('"' + rel_table + '"."' + field.column_name + '" AS "' + alias + '"')
+            rel_id = '"' + rel_table + '"."' + rel_model._meta.primary_key.column_name + '"'
+            fk_id = '"' + table + '"."' + model_class._meta.fields[join].column_name + '"'
+            sql = 'SELECT ' + ', '.join(columns) + ' FROM "' + table + '" JOIN "' + rel_table + '" ON ' + rel_id
+            sql += ' = ' + fk_id + ' WHERE ' + where
+        else:
+            columns = ', '.join('"' + field.column_name + '"' for field in model_class._meta.sorted_fields)
+            sql = 'SELECT ' + columns + ' FROM "' + table + '" WHERE ' + where
+        count = max([int(n) for n in cls.PARAM.findall(where)] or [0])
+        params = count and ' (' + ', '.join(['%s'] * count) + ')' or ''
+        cls.STATEMENTS[name] = (model_class, 'PREPARE ' + name + ' AS ' + sql, 'EXECUTE ' + name + params)
+
+    @classmethod
+    def execute(cls, name, *params):
+        # returns a cursor, using the same routing to the replica as a select would
+        database = peewee_db
+        if replica_db is not None:
+            database = Replica.database()
+            if database is replica_db:
+                try:
+                    return cls.run(database, name, params)
+                except (psycopg2.InterfaceError, psycopg2.OperationalError, InterfaceError, OperationalError,
+                        MaxConnectionsExceeded) as e:
+                    Replica.failed(e)
+                    database = peewee_db
+
+        return cls.run(database, name, params)
+
+    @classmethod
+    def run(cls, database, name, params):
+        model_class, prepare_sql, execute_sql = cls.STATEMENTS[name]
+
+        stats = QUERIES.get()
+        start = time.perf_counter()
+        # this goes straight to the connection because peewee would build and send the same thing anyway
+        connection = database.connection()
+        cursor = connection.cursor()
+        try:
+            prepared = cls.PREPARED.get(connection)
+            if prepared is None:
+                prepared = cls.PREPARED[connection] = set()
+            if name not in prepared:
+                cursor.execute(prepare_sql)
+                prepared.add(name)
+            cursor.execute(execute_sql, params)
+            if not database.in_transaction():
+                # like peewee does, otherwise the connection sits idle in a transaction holding locks on the tables
+                # which blocks things like detaching partitions and building indexes concurrently
+                connection.commit()
+        except Exception:
+            # leave the connection usable for the next query rather than stuck in an aborted transaction
+            if not database.in_transaction():
+                connection.rollback()
+            raise
+        finally:
+            if stats is not None:
+                stats.record(execute_sql, time.perf_counter() - start)
+        return cursor
+
+    @classmethod
+    def first(cls, name, *params):
+        cursor = cls.execute(name, *params)
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        model_class = cls.STATEMENTS[name][0]
+        record = {}
+        joined = {}
+        for column, value in zip([column[0] for column in cursor.description], row):
+            if '__' in column:
+                join, column = column.split('__', 1)
+                joined.setdefault(join, {})[column] = value
+            else:
+                record[column] = value
+
+        # rows the request has already loaded are kept rather than replaced, so there's only ever one of each
+        instance = IdentityMap.add(AsyncDB.toModel(model_class, record))
+        for join, rel_record in joined.items():
+            rel_instance = IdentityMap.add(AsyncDB.toModel(model_class._meta.fields[join].rel_model, rel_record))
+            setattr(instance, join, rel_instance)
+            instance._dirty.discard(join)
+        return instance
 
 
 class BaseModel(Model):
@@ -44,29 +536,98 @@ class BaseModel(Model):
     created_dt = DateTimeField(default=datetime.utcnow)
     modified_dt = DateTimeField(default=datetime.utcnow)
 
+    # the defaults for `deleteInBatches`
+    DELETE_BATCH_SIZE = 1000
+    DELETE_BATCH_PAUSE = 0.1 # in seconds
+
     @property
     def slug(self):
         return str(self.id)
 
+    @classmethod
+    def select(cls, *fields):
+        # plain selects may be routed to the replica, everything else always goes to the primary
+        query = super().select(*fields)
+        if replica_db is not None:
+            query._database = Replica.database()
+        return query
+
     @classmethod
     def getBySlug(cls, slug):
         # this is preferable to `get_by_id` because we can return None rather than an error
-        return cls.select().where(cls.id == slug).first()
+        instance = IdentityMap.get(cls, slug)
+        if instance is not None:
+            return instance
+        statement = cls._meta.table_name + '_by_id'
+        if statement in Prepared.STATEMENTS:
+            return Prepared.first(statement, slug)
+        return IdentityMap.add(cls.select().where(cls.id == slug).first())
+
+    @classmethod
+    def deleteInBatches(cls, where, batch_size=None, pause=None):
+        """ deletes every row matching `where` a bounded number at a time, returns how many were deleted """
+        # deleting everything in one statement holds row locks and grows the WAL for as long as it takes
+        # so instead delete a bounded chunk of primary keys at a time, each in its own short transaction
+        # with a pause in between that lets other queries (like logins touching auths) get through
+        batch_size = batch_size or cls.DELETE_BATCH_SIZE
+        pause = cls.DELETE_BATCH_PAUSE if pause is None else pause
+
+        pk = cls._meta.primary_key
+        table = cls._meta.table_name
+        total = 0
+        batches = 0
+        start = time.monotonic()
+        while True:
+            ids = cls.select(pk).where(where).order_by(pk).limit(batch_size)
+            with peewee_db.atomic():
+                deleted = cls.delete().where(pk.in_(ids)).execute()
+
+            total += deleted
+            batches += 1
+            logging.info('Batch %d removed %d rows from %s (%d total)', batches, deleted, table, total)
+
+            if deleted < batch_size:
+                break
+
+            if pause:
+                time.sleep(pause)
+
+        logging.info('Removed %d rows from %s in %d batches and %.3fs', total, table, batches,
+            time.monotonic() - start)
+
+        return total
+
+    @classmethod
+    def partitions(cls):
+        # the names of the tables holding this one's rows if it's partitioned, otherwise an empty list
+        cursor = peewee_db.execute_sql('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = %s::regclass ORDER BY c.relname', (cls._meta.table_name,))
+        return [row[0] for row in cursor.fetchall()]
 
     def refresh(self):
-        try:
-            entity = type(self).get(self._pk_expr())
-        except DoesNotExist:
-            entity = None
+        # during a request this is the copy it already loaded, which `save` keeps up to date
+        entity = IdentityMap.get(type(self), self.slug)
+        if entity is None:
+            try:
+                entity = type(self).get(self._pk_expr())
+            except DoesNotExist:
+                entity = None
+            IdentityMap.add(entity)
         return entity
 
     def save(self, *args, **kwargs):
         self.modified_dt = datetime.utcnow()
-        return super().save(*args, **kwargs)
+        result = super().save(*args, **kwargs)
+        IdentityMap.add(self, replace=True)
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        IdentityMap.remove(type(self), self.slug)
+        return super().delete_instance(*args, **kwargs)
 
 
 class Account(BaseModel):
-    email = CharField()
+    email = CharField(index=True)
     password_salt = CharField()
     hashed_password = CharField()
     hashed_token = CharField(null=True)
@@ -80,25 +641,55 @@ class Account(BaseModel):
 
     @classmethod
     def getByAuth(cls, slug):
-        auth = Auth.getBySlug(slug)
+        auth = Auth.getWithAccount(slug)
         return auth and auth.account or None
 
     @classmethod
     def getByEmail(cls, email):
-        return cls.select().where(cls.email == email).first()
+        return Prepared.first('account_by_email', email)
 
     @classmethod
     def hashPassword(cls, password, salt):
+        # NOTE: this is fast, which is fine for random tokens but not for passwords anymore, see `derivePassword`
         return sha512(password.encode('utf8') + salt).hexdigest()
 
+    @classmethod
+    def derivePassword(cls, password, salt, cost=None):
+        # a deliberately slow hash that records its cost, so raising the cost later doesn't break existing ones
+        # WARNING! this takes most of a CPU for a noticeable time, so use `Passwords` rather than calling it directly
+        cost = cost or constants.PASSWORD_HASH_COST
+        n = 2 ** cost
+        # this needs about 128 * r * (n + p + 2) bytes, which is 32MB at the default cost
+        derived = scrypt(password.encode('utf8'), salt=salt, n=n, r=8, p=1, maxmem=2 * 128 * 8 * (n + 3), dklen=64)
+        return 'scrypt$' + str(cost) + '$' + derived.hex()
+
     @classmethod
     def changePassword(cls, password):
         salt = base64.b64encode(os.urandom(64))
-        hashed_password = cls.hashPassword(password, salt)
+        hashed_password = cls.derivePassword(password, salt)
         return salt, hashed_password
 
+    @classmethod
+    def checkPassword(cls, password, password_salt, hashed_password):
+        # returns whether the password matches, and if so whether it's stored with an old hash
+        # in which case it also returns a new salt and hash to replace it with, otherwise None
+        salt = password_salt.encode('utf8')
+        if hashed_password.startswith('scrypt$'):
+            cost = int(hashed_password.split('$')[1])
+            matches = compare_digest(cls.derivePassword(password, salt, cost=cost), hashed_password)
+            outdated = cost != constants.PASSWORD_HASH_COST
+        else:
+            # from before passwords used scrypt
+            matches = compare_digest(cls.hashPassword(password, salt), hashed_password)
+            outdated = True
+
+        if matches and outdated:
+            salt, hashed_password = cls.changePassword(password)
+            return True, (salt.decode(), hashed_password)
+        return matches, None
+
     def getAuth(self, user_agent):
-        return self.auths.where(Auth.user_agent == user_agent).first()
+        return Prepared.first('auth_by_account_user_agent', self.id, user_agent)
 
     def hashToken(self, token):
         token_salt = self.slug + '-' + self.token_dt.isoformat()
@@ -116,7 +707,16 @@ class Account(BaseModel):
         return {'email': self.email}
 
 
+class PartitionedAutoField(AutoField):
+    """ an auto incrementing id that is only part of the primary key """
+
+    def ddl(self, ctx):
+        # postgres requires the partition key to be in the primary key, so it's declared on the table instead
+        return NodeList((Entity(self.column_name), self.ddl_datatype(ctx), SQL('NOT NULL')))
+
+
 class Auth(BaseModel):
+    id = PartitionedAutoField()
     user_agent = CharField()
     os = CharField(null=True)
     browser = CharField(null=True)
@@ -124,8 +724,102 @@ class Auth(BaseModel):
     ip = CharField()
     account = ForeignKeyField(Account, backref='auths')
 
+    # auths are stored in one partition per week of `modified_dt` so expiring them drops whole tables
+    # NOTE: there's an index on `id` in every partition, so looking one up is a probe per partition, not a scan
+    PARTITION_DAYS = 7
+    PARTITIONS_AHEAD = 2 # always have this many empty partitions ready for the future
+    DETACH_LOCK_TIMEOUT = '5s' # how long dropping an old partition waits for other queries on the table
+    PARTITION_EPOCH = date(2000, 1, 3) # a monday, so partitions run monday to monday
+
     class Meta:
         table_name = 'auth'
+        constraints = [SQL('PRIMARY KEY ("id", "modified_dt")')]
+        table_settings = ['PARTITION BY RANGE ("modified_dt")']
+        indexes = (
+            (('modified_dt',), False), # for expiring old auths
+            (('account', 'user_agent'), False), # for finding an existing auth when logging in
+        )
+
+    @classmethod
+    def create_table(cls, *args, **kwargs):
+        super().create_table(*args, **kwargs)
+
+        # anything outside of the weekly partitions (e.g. if the cron stops running) lands in the default one
+        # so inserts never fail, and `addPartition` moves those rows out if it creates a partition for them later
+        peewee_db.execute_sql('CREATE TABLE IF NOT EXISTS "auth_default" PARTITION OF "auth" DEFAULT')
+        cls.addPartitions()
+
+    @classmethod
+    def partitionStart(cls, dt):
+        day = dt.date() if isinstance(dt, datetime) else dt
+        return day - timedelta(days=(day - cls.PARTITION_EPOCH).days % cls.PARTITION_DAYS)
+
+    @classmethod
+    def partitionName(cls, start):
+        return 'auth_p' + start.strftime('%Y%m%d')
+
+    @classmethod
+    def addPartition(cls, start):
+        # creating a partition with `PARTITION OF` locks the whole table, which would block logins
+        # so build it as a regular table and attach it, which doesn't block reads or writes on the other partitions
+        name = cls.partitionName(start)
+        bounds = (start.isoformat(), (start + timedelta(days=cls.PARTITION_DAYS)).isoformat())
+        with peewee_db.atomic():
+            peewee_db.execute_sql('CREATE TABLE "' + name + '" (LIKE "auth" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+            # attaching fails if the default partition has rows in this range, so move them over first
+            peewee_db.execute_sql('WITH moved AS (DELETE FROM "auth_default" WHERE "modified_dt" >= %s '
+                'AND "modified_dt" < %s RETURNING *) INSERT INTO "' + name + '" SELECT * FROM moved', bounds)
+            peewee_db.execute_sql('ALTER TABLE "auth" ATTACH PARTITION "' + name + '" FOR VALUES FROM (%s) TO (%s)',
+                bounds)
+        return name
+
+    @classmethod
+    def addPartitions(cls, now=None):
+        """ makes sure there are partitions for this week and the weeks ahead, returns any new ones """
+        start = cls.partitionStart(now or datetime.utcnow())
+        existing = cls.partitions()
+        added = []
+        for i in range(cls.PARTITIONS_AHEAD + 1):
+            week = start + timedelta(days=i * cls.PARTITION_DAYS)
+            if cls.partitionName(week) not in existing:
+                added.append(cls.addPartition(week))
+        return added
+
+    @classmethod
+    def dropPartitions(cls, before):
+        """ detaches and drops every partition that only holds rows older than `before`, returns their names """
+        dropped = []
+        for name in cls.partitions():
+            if name == 'auth_default':
+                continue
+
+            start = datetime.strptime(name[len('auth_p'):], '%Y%m%d')
+            if start + timedelta(days=cls.PARTITION_DAYS) <= before:
+                try:
+                    with peewee_db.atomic():
+                        # detaching needs a brief exclusive lock on the parent, so give up on it (until the next run)
+                        # rather than queue behind a long query and block every login waiting behind us
+                        peewee_db.execute_sql("SET LOCAL lock_timeout = '" + cls.DETACH_LOCK_TIMEOUT + "'")
+                        peewee_db.execute_sql('ALTER TABLE "auth" DETACH PARTITION "' + name + '"')
+                        peewee_db.execute_sql('DROP TABLE "' + name + '"')
+                except OperationalError as e:
+                    # peewee keeps the original error, anything other than the lock timeout is a real problem
+                    if not isinstance(getattr(e, 'orig', None), psycopg2.errors.LockNotAvailable):
+                        raise
+                    logging.warning('Timed out waiting to detach auth partition %s, trying again next run.', name)
+                    continue
+                dropped.append(name)
+        return dropped
+
+    @classmethod
+    def getWithAccount(cls, slug):
+        # the auth with its account already loaded, in a single query unless the request has already loaded both
+        auth = IdentityMap.get(cls, slug)
+        if auth is not None and IdentityMap.get(Account, auth.account_id) is not None:
+            auth.account = IdentityMap.get(Account, auth.account_id)
+            auth._dirty.discard('account')
+            return auth
+        return Prepared.first('auth_with_account', slug)
 
     def toDict(self):
         return {
@@ -139,6 +833,256 @@ class Auth(BaseModel):
         }
 
 
+# the queries that run the most, see `Prepared`
+Prepared.register('account_by_id', Account, '"id" = $1')
+Prepared.register('account_by_email', Account, '"email" = $1 LIMIT 1')
+Prepared.register('auth_by_id', Auth, '"id" = $1')
+Prepared.register('auth_by_account_user_agent', Auth, '"account_id" = $1 AND "user_agent" = $2 LIMIT 1')
+Prepared.register('auth_with_account', Auth, '"auth"."id" = $1', join='account')
+
+
+class AuthTouches(object):
+    """ buffers when each auth was last used and writes them all at once every few seconds """
+
+    # NOTE: this is per process, so a restart loses at most the last `FLUSH_SECONDS` of activity
+    #       which only matters for auths that are about to expire anyway (see `AuthCron`)
+
+    FLUSH_SECONDS = 5
+    BATCH_SIZE = 1000 # auths per UPDATE, to keep each statement and its locks small
+
+    pending = {} # auth id: (modified_dt, ip)
+    lock = threading.Lock()
+    callback = None
+
+    @classmethod
+    def touch(cls, auth_id, ip, modified_dt=None):
+        # cheap enough to call on every request, only the latest touch of each auth is kept
+        with cls.lock:
+            cls.pending[int(auth_id)] = (modified_dt or datetime.utcnow(), ip)
+
+    @classmethod
+    def start(cls):
+        # called once per process by `main.py`
+        if cls.callback is None:
+            cls.callback = PeriodicCallback(cls.flushLater, cls.FLUSH_SECONDS * 1000)
+            cls.callback.start()
+
+    @classmethod
+    async def flushLater(cls):
+        try:
+            await async_db(cls.flush)
+        except DatabaseBusy:
+            # everything is still pending, so it goes out with the next flush
+            pass
+
+    @classmethod
+    def flush(cls):
+        # returns the number of auths updated
+        with cls.lock:
+            touches, cls.pending = cls.pending, {}
+        if not touches:
+            return 0
+
+        rows = list(touches.items())
+        updated = 0
+        try:
+            for i in range(0, len(rows), cls.BATCH_SIZE):
+                batch = rows[i:i + cls.BATCH_SIZE]
+                params = []
+                for auth_id, (modified_dt, ip) in batch:
+                    params.extend([auth_id, modified_dt, ip])
+                # the types are only needed on the first row, the rest of the VALUES list follows it
+                # and a touch never moves an auth backwards in time, in case it was saved more recently
+                values = ', '.join(['(%s::integer, %s::timestamp, %s::varchar)'] + ['(%s, %s, %s)'] * (len(batch) - 1))
+                cursor = peewee_db.execute_sql('UPDATE "auth" SET "modified_dt" = v.modified_dt, "ip" = v.ip '
+                    'FROM (VALUES ' + values + ') AS v (id, modified_dt, ip) '
+                    'WHERE "auth"."id" = v.id AND "auth"."modified_dt" < v.modified_dt', params)
+                updated += cursor.rowcount
+                rows[i:i + cls.BATCH_SIZE] = [None] * len(batch)
+        except Exception:
+            # put back whatever didn't get written, without replacing anything newer that came in meanwhile
+            with cls.lock:
+                for row in rows:
+                    if row is not None:
+                        cls.pending.setdefault(row[0], row[1])
+            logging.exception('Failed to write auth touches, will retry.')
+
+        return updated
+
+
+class Passwords(object):
+    """ hashes and checks passwords in a pool of processes, so a slow hash doesn't hold up the IOLoop """
+
+    # NOTE: these are processes rather than threads so that a burst of logins uses every CPU
+    #       while this process keeps serving everything else
+
+    EXECUTOR = None
+    NO_ACCOUNT_SALT = 'no account' # what's hashed when there isn't one, never matches since there's no hash
+
+    @classmethod
+    def executor(cls):
+        if cls.EXECUTOR is None:
+            cls.EXECUTOR = ProcessPoolExecutor(max_workers=constants.PASSWORD_HASH_WORKERS)
+        return cls.EXECUTOR
+
+    @classmethod
+    def start(cls):
+        # WARNING! call this at startup before anything else starts a thread, as the processes are forked from this one
+        # and a fork that happens while another thread holds a lock (e.g. in logging) can deadlock the child
+        # submitting something is what forks them, so they're all ready before the first login too
+        cls.executor().submit(int).result()
+
+    @classmethod
+    async def change(cls, password):
+        # returns a new salt and hashed password, like `Account.changePassword`
+        salt, hashed_password = await IOLoop.current().run_in_executor(cls.executor(), Account.changePassword,
+            password)
+        return salt, hashed_password
+
+    @classmethod
+    async def check(cls, account, password):
+        # returns whether the password matches, and replaces an outdated hash with a new one while it's known
+        if account is None:
+            # still hash it, otherwise how long a login takes reveals whether there's an account for the email
+            password_salt, hashed_password = cls.NO_ACCOUNT_SALT, 'scrypt$' + str(constants.PASSWORD_HASH_COST) + '$'
+        else:
+            password_salt, hashed_password = account.password_salt, account.hashed_password
+        matches, upgrade = await IOLoop.current().run_in_executor(cls.executor(), Account.checkPassword,
+            password, password_salt, hashed_password)
+        if upgrade:
+            account.password_salt, account.hashed_password = upgrade
+            await async_db(account.save)
+        return matches
+
+
+class AsyncDB(object):
+    """ awaitable versions of the hottest queries that don't need a thread or the shared peewee connection """
+
+    # NOTE: asyncpg pools belong to the event loop they were created on, so we keep track of that too
+    POOL = None
+    POOL_LOOP = None
+    POOL_LOCK = None
+
+    @classmethod
+    async def pool(cls):
+        loop = asyncio.get_event_loop()
+        if cls.POOL_LOOP is not loop:
+            cls.POOL = None
+            cls.POOL_LOOP = loop
+            cls.POOL_LOCK = asyncio.Lock()
+
+        async with cls.POOL_LOCK:
+            if cls.POOL is None:
+                cls.POOL = await asyncpg.create_pool(database=constants.DB_NAME, user=constants.DB_USER,
+                    password=constants.DB_PASS, host=constants.DB_HOST, port=int(constants.DB_PORT),
+                    ssl=constants.DB_SSLMODE, min_size=1, max_size=constants.DB_ASYNC_MAX_CONNECTIONS)
+        return cls.POOL
+
+    @classmethod
+    async def close(cls):
+        if cls.POOL is not None and cls.POOL_LOOP is asyncio.get_event_loop():
+            await cls.POOL.close()
+        cls.POOL = cls.POOL_LOOP = cls.POOL_LOCK = None
+
+    @classmethod
+    def toModel(cls, model_class, record):
+        # build an instance the same way peewee does for query results, so it isn't considered changed
+        if record is None:
+            return None
+        instance = model_class(__no_default__=1, **dict(record))
+        instance._dirty.clear()
+        return instance
+
+    @classmethod
+    def wrote(cls):
+        # writes here skip `PrimaryDatabase`, so they mark the request as having written the same way it does
+        route = ROUTE.get()
+        if route is not None:
+            route.wrote = True
+
+    @classmethod
+    async def getByAuth(cls, slug):
+        if not asyncpg:
+            return await async_db(Account.getByAuth, slug)
+
+        pool = await cls.pool()
+        record = await pool.fetchrow('SELECT account.* FROM auth JOIN account ON account.id = auth.account_id '
+            'WHERE auth.id = $1', int(slug))
+        return IdentityMap.add(cls.toModel(Account, record))
+
+    @classmethod
+    async def getByEmail(cls, email):
+        if not asyncpg:
+            return await async_db(Account.getByEmail, email)
+
+        pool = await cls.pool()
+        record = await pool.fetchrow('SELECT * FROM account WHERE email = $1 LIMIT 1', email)
+        return IdentityMap.add(cls.toModel(Account, record))
+
+    @classmethod
+    async def touchAuth(cls, account, user_agent, ip):
+        # updates the last used time and IP of an existing auth for this device, or returns None if there isn't one
+        if not asyncpg:
+            auth = await async_db(account.getAuth, user_agent)
+        else:
+            pool = await cls.pool()
+            record = await pool.fetchrow('SELECT * FROM auth WHERE account_id = $1 AND user_agent = $2 LIMIT 1',
+                account.id, user_agent)
+            auth = cls.toModel(Auth, record)
+
+        # the write itself is batched with the other touches, see `AuthTouches`
+        if auth:
+            auth.modified_dt = datetime.utcnow()
+            auth.ip = ip
+            auth._dirty.clear()
+            AuthTouches.touch(auth.id, ip, auth.modified_dt)
+        return auth
+
+    @classmethod
+    async def createAuth(cls, account, user_agent, ip, os=None, browser=None, device=None):
+        if not asyncpg:
+            return await async_db(partial(Auth.create, account=account, user_agent=user_agent, ip=ip,
+                os=os, browser=browser, device=device))
+
+        pool = await cls.pool()
+        now = datetime.utcnow()
+        record = await pool.fetchrow('INSERT INTO auth (created_dt, modified_dt, user_agent, os, browser, device, '
+            'ip, account_id) VALUES ($1, $1, $2, $3, $4, $5, $6, $7) RETURNING *',
+            now, user_agent, os, browser, device, ip, account.id)
+        cls.wrote()
+        return cls.toModel(Auth, record)
+
+    @classmethod
+    async def deleteAuth(cls, slug):
+        # returns the number of auths removed
+        IdentityMap.remove(Auth, slug)
+        if not asyncpg:
+            return await async_db(Auth.delete().where(Auth.id == slug).execute)
+
+        pool = await cls.pool()
+        status = await pool.execute('DELETE FROM auth WHERE id = $1', int(slug))
+        cls.wrote()
+        return int(status.split()[-1])
+
+
+class SessionData(BaseModel):
+    """ a session kept on the server rather than in its cookie, see sessions.py """
+    id = CharField(primary_key=True) # the random id in the `sid` cookie
+    data = BlobField() # encoded by `Session` in controllers/_base.py
+    expires_dt = DateTimeField(index=True)
+
+    class Meta:
+        table_name = 'session'
+
+
+class Migration(BaseModel):
+    """ a record of each one time migration that has been run, see migrate.py """
+    name = CharField(unique=True)
+
+    class Meta:
+        table_name = 'migration'
+
+
 # CAREFUL when creating new models - avoid Postgres keywords if that's your backend
 # while peewee can handle them other ORMs or manual work might not
 # see https://www.postgresql.org/docs/current/sql-keywords-appendix.html
@@ -150,7 +1094,7 @@ def generateToken(size):
 
 def reset():
     # order matters here - have to delete in the right direction given foreign key constraints
-    tables = [Auth, Account]
+    tables = [Migration, SessionData, Auth, Account]
 
     for table in tables:
         table.drop_table()
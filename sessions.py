@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+import secrets
+import threading
+import time
+
+from config import constants
+import model
+
+
+class SessionStore(object):
+    """ the interface every server side session store implements, data is always the encoded bytes """
+
+    def load(self, sid):
+        # returns None if there isn't a session with this id or it has expired
+        raise NotImplementedError
+
+    def save(self, sid, data, expires):
+        # expires is in seconds from now
+        raise NotImplementedError
+
+    def delete(self, sid):
+        raise NotImplementedError
+
+    def cleanup(self, batch_size=None):
+        # removes expired sessions and returns how many there were
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """ keeps sessions in this process, which loses them on restart and doesn't share them with other workers """
+
+    CLEANUP_EVERY = 100 # saves, there's no cron in each worker so expired sessions are removed as it goes
+    BATCH_SIZE = 1000
+
+    def __init__(self):
+        self.sessions = {} # sid: (data, expires_at)
+        self.saves = 0
+        self.lock = threading.Lock()
+
+    def load(self, sid):
+        entry = self.sessions.get(sid)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def save(self, sid, data, expires):
+        with self.lock:
+            self.sessions[sid] = (data, time.time() + expires)
+            self.saves += 1
+            cleanup = self.saves % self.CLEANUP_EVERY == 0
+        if cleanup:
+            self.cleanup()
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    def cleanup(self, batch_size=None):
+        # a bounded number at a time so the lock is never held for long, and requests can save in between
+        batch_size = batch_size or self.BATCH_SIZE
+        now = time.time()
+        total = 0
+        while True:
+            with self.lock:
+                expired = []
+                for sid, entry in self.sessions.items():
+                    if entry[1] <= now:
+                        expired.append(sid)
+                        if len(expired) >= batch_size:
+                            break
+                for sid in expired:
+                    del self.sessions[sid]
+
+            total += len(expired)
+            if len(expired) < batch_size:
+                return total
+
+
+class PostgresSessionStore(SessionStore):
+    """ keeps sessions in the session table, shared by every worker """
+
+    def load(self, sid):
+        # always from the primary - a session usually changes right before the redirect that reads it back
+        SessionData = model.SessionData
+        query = SessionData.select(SessionData.data).where(SessionData.id == sid,
+            SessionData.expires_dt > datetime.utcnow())
+        row = query.bind(model.peewee_db).first()
+        return row and bytes(row.data) or None
+
+    def save(self, sid, data, expires):
+        SessionData = model.SessionData
+        now = datetime.utcnow()
+        expires_dt = now + timedelta(seconds=expires)
+        SessionData.insert(id=sid, data=data, expires_dt=expires_dt).on_conflict(conflict_target=[SessionData.id],
+            update={SessionData.data: data, SessionData.expires_dt: expires_dt, SessionData.modified_dt: now}).execute()
+
+    def delete(self, sid):
+        model.SessionData.delete().where(model.SessionData.id == sid).execute()
+
+    def cleanup(self, batch_size=None):
+        # this runs from `SessionCron`, a batch at a time so it doesn't hold locks that would block requests
+        return model.SessionData.deleteInBatches(model.SessionData.expires_dt <= datetime.utcnow(),
+            batch_size=batch_size)
+
+
+def makeSessionStore(name):
+    # None keeps sessions in their cookie
+    if name == 'postgres':
+        return PostgresSessionStore()
+    if name == 'memory':
+        return MemorySessionStore()
+    assert not name, 'Unknown session store: ' + name
+    return None
+
+
+def newSessionId():
+    # long and random enough that it can't be guessed, so unlike the session cookie it doesn't need signing
+    return secrets.token_urlsafe(32)
+
+
+STORE = makeSessionStore(constants.SESSION_STORE)
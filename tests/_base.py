@@ -10,6 +10,8 @@ from peewee import OperationalError
 os.environ['DB_NAME'] = 'trestle_test'
 os.environ['DB_USER'] = 'trestle_test'
 os.environ['DB_PASS'] = 'trestle_test'
+# the lowest cost keeps creating test accounts fast
+os.environ['PASSWORD_HASH_COST'] = '1'
 
 app_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.append(app_path)
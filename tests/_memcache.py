@@ -0,0 +1,110 @@
+import socketserver
+import threading
+import time
+
+
+# a local stand in for memcached that speaks enough of the text protocol for the cache backend tests
+# see https://github.com/memcached/memcached/blob/master/doc/protocol.txt
+class MemcacheHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+
+            parts = line.decode().split()
+            if not parts:
+                continue
+
+            command = parts[0]
+            noreply = parts[-1] == 'noreply'
+            response = None
+
+            if command in ('get', 'gets'):
+                response = b''
+                for key in parts[1:]:
+                    entry = self.server.getEntry(key)
+                    if entry:
+                        flags, data = entry
+                        response += b'VALUE ' + key.encode() + b' ' + str(flags).encode() + b' '
+                        response += str(len(data)).encode() + b'\r\n' + data + b'\r\n'
+                response += b'END\r\n'
+            elif command in ('set', 'add', 'replace'):
+                key, flags, expires, length = parts[1], int(parts[2]), int(parts[3]), int(parts[4])
+                data = self.rfile.read(length + 2)[:-2]
+                exists = self.server.getEntry(key) is not None
+                if (command == 'add' and exists) or (command == 'replace' and not exists):
+                    response = b'NOT_STORED\r\n'
+                else:
+                    self.server.setEntry(key, flags, data, expires)
+                    response = b'STORED\r\n'
+            elif command == 'delete':
+                if self.server.deleteEntry(parts[1]):
+                    response = b'DELETED\r\n'
+                else:
+                    response = b'NOT_FOUND\r\n'
+            elif command == 'flush_all':
+                self.server.flush()
+                response = b'OK\r\n'
+            elif command == 'version':
+                response = b'VERSION stand-in\r\n'
+            elif command == 'quit':
+                break
+            else:
+                response = b'ERROR\r\n'
+
+            if response is not None and not noreply:
+                self.wfile.write(response)
+                self.wfile.flush()
+
+
+class MemcacheServer(socketserver.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        # port 0 picks any free port, the real one is available afterwards from `address`
+        super().__init__((host, port), MemcacheHandler)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address
+
+    def getEntry(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                flags, data, expires_at = entry
+                if expires_at and expires_at <= time.time():
+                    del self.entries[key]
+                    return None
+                return flags, data
+        return None
+
+    def setEntry(self, key, flags, data, expires):
+        # like memcached, values over 30 days are absolute unix timestamps, otherwise relative seconds
+        if expires and expires <= 60 * 60 * 24 * 30:
+            expires = time.time() + expires
+        with self.lock:
+            self.entries[key] = (flags, data, expires)
+
+    def deleteEntry(self, key):
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+
+    def flush(self):
+        with self.lock:
+            self.entries.clear()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
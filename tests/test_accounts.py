@@ -0,0 +1,84 @@
+import csv
+import io
+
+from _base import BaseTestCase, UCHAR
+import accounts
+import model
+
+
+class TestAccounts(BaseTestCase):
+
+    def test_RowStream(self):
+        stream = accounts.RowStream(iter([['a', 1], ['b' + UCHAR, None], ['c,d', 3]]))
+        data = ''
+        chunk = stream.read(4)
+        while chunk:
+            assert len(chunk) <= 4
+            data += chunk
+            chunk = stream.read(4)
+        assert data == 'a,1\r\nb' + UCHAR + ',\r\n"c,d",3\r\n'
+        assert stream.count == 3
+
+    def test_hashedRows(self):
+        # every row comes back hashed and in order, however the batches line up
+        rows = [{'email': str(i) + '@example.com', 'password': 'password' + str(i)} for i in range(7)]
+        with accounts.ProcessPoolExecutor(max_workers=2) as executor:
+            hashed = list(accounts.hashedRows(iter(rows), executor, 2, batch_size=3))
+
+        assert [row['email'] for row in hashed] == [str(i) + '@example.com' for i in range(7)]
+        for i, row in enumerate(hashed):
+            assert 'password' not in row
+            assert model.Account.checkPassword('password' + str(i), row['password_salt'], row['hashed_password']) \
+                == (True, None)
+
+    def test_importAccounts(self):
+        existing = self.createAccount(email='existing@example.com')
+
+        source = io.StringIO()
+        writer = csv.writer(source)
+        writer.writerow(['email', 'password', 'is_admin', 'unknown'])
+        writer.writerow(['New@Example.com', 'new password' + UCHAR, 't', 'ignored'])
+        writer.writerow(['other@example.com', 'other password', '', ''])
+        writer.writerow(['existing@example.com', 'existing password', '', ''])
+        writer.writerow(['other@example.com', 'duplicate password', '', ''])
+        writer.writerow(['not an email', 'password', '', ''])
+        writer.writerow(['nopassword@example.com', '', '', ''])
+        source.seek(0)
+
+        added, skipped = accounts.importAccounts(source, workers=2, batch_size=2)
+        assert added == 2
+        assert skipped == {'invalid': 2, 'existing': 2}
+
+        account = model.Account.getByEmail('new@example.com')
+        assert account.is_admin
+        assert model.Account.checkPassword('new password' + UCHAR, account.password_salt,
+            account.hashed_password) == (True, None)
+        assert account.created_dt
+
+        other = model.Account.getByEmail('other@example.com')
+        assert not other.is_admin
+        assert model.Account.getBySlug(existing.id).hashed_password == existing.hashed_password
+
+    def test_exportAccounts(self):
+        self.createAccount(email='first@example.com', is_admin=True)
+        self.createAccount(email='second@example.com')
+
+        output = io.StringIO()
+        assert accounts.exportAccounts(output) == 2
+        output.seek(0)
+        rows = list(csv.DictReader(output))
+        assert [row['email'] for row in rows] == ['first@example.com', 'second@example.com']
+        assert rows[0]['is_admin'] == 't'
+
+        # an export can be imported again as is, without rehashing the passwords
+        first = model.Account.getByEmail('first@example.com')
+        model.Account.delete().execute()
+        output.seek(0)
+        assert accounts.importAccounts(output) == (2, {'invalid': 0, 'existing': 0})
+
+        account = model.Account.getByEmail('first@example.com')
+        assert account.id != first.id
+        assert account.is_admin
+        assert account.hashed_password == first.hashed_password
+        assert account.password_salt == first.password_salt
+        assert account.created_dt == first.created_dt
@@ -1,3 +1,4 @@
+import gzip
 import json
 import logging
 from datetime import timedelta
@@ -28,6 +29,12 @@ class BaseTestController(BaseTestCase, AsyncHTTPTestCase):
         # this must be imported after the above setup in order for the stubs to work
         self.controller_base = controller_base
 
+    def tearDown(self):
+        # native async connections belong to this test's loop, so they have to be closed before it is
+        self.io_loop.run_sync(model.AsyncDB.close)
+        AsyncHTTPTestCase.tearDown(self)
+        BaseTestCase.tearDown(self)
+
     def fetch(self, *args, **kwargs):
         assert ' ' not in args[0], 'Unescaped space in URL'
 
@@ -171,14 +178,54 @@ class BaseMockController(BaseTestController):
 
     def mockSessions(self):
         # this is used by tests that want to bypass needing to perform session-dependent actions within a request
-        self.controller.session = {}
-        self.controller.orig_session = {}
+        self.controller.session = controller_base.Session()
 
     def mockLogin(self):
         self.auth = self.createAuth(self.account)
         self.controller.session["auth_key"] = self.auth.slug
 
 
+class TestSession(BaseTestCase):
+
+    def test_encode(self):
+        Session = controller_base.Session
+        data = {'flash': {'level': 'info', 'message': 'test' + UCHAR}, 'last': 1}
+        encoded = Session.encode(data)
+        assert encoded[:1] == b'j'
+        assert len(encoded) < len(json.dumps(data))
+        assert Session.decode(encoded) == data
+
+        # big ones are compressed
+        data = {'form_data': {'field' + str(i): 'value' for i in range(50)}}
+        encoded = Session.encode(data)
+        assert encoded[:1] == b'J'
+        assert len(encoded) < len(json.dumps(data)) / 2
+        assert Session.decode(encoded) == data
+
+        # cookies from before still work, and unreadable ones are treated as empty
+        assert Session.decode(json.dumps({'flash': 'old'}).encode()) == {'flash': 'old'}
+        assert Session.decode(b'mnot enabled') == {}
+        assert Session.decode(b'Jnot compressed') == {}
+        assert Session.decode(None) == {}
+
+    def test_dirty(self):
+        session = controller_base.Session(lambda: controller_base.Session.encode({'flash': 'hi'}))
+        assert 'flash' in session
+        assert session['flash'] == 'hi'
+        assert not session.dirty
+
+        session['flash'] = 'hi'
+        assert session.pop('missing') is None
+        assert not session.dirty
+
+        assert session.pop('flash') == 'hi'
+        assert session.dirty
+
+        session = controller_base.Session()
+        session['errors'] = {}
+        assert session.dirty
+
+
 class TestBase(BaseMockController):
 
     def setUp(self):
@@ -204,6 +251,26 @@ class TestBase(BaseMockController):
         await self.controller.prepare()
         assert self.called
 
+        # no database connection is borrowed until something actually queries
+        assert model.peewee_db.is_closed()
+        model.Account.select().count()
+        assert not model.peewee_db.is_closed()
+        self.controller.on_finish()
+        assert model.peewee_db.is_closed()
+
+        # but one that another request on the same thread borrowed is left for that request to hand back
+        await self.controller.prepare()
+        route = model.ROUTE.get()
+        other_route = model.Replica.route()
+        model.Account.select().count()
+        model.ROUTE.set(route)
+        self.controller.on_finish()
+        assert not model.peewee_db.is_closed()
+
+        model.ROUTE.set(other_route)
+        other_route.release()
+        assert model.peewee_db.is_closed()
+
         # if there is an error or redirect in before then the request should be finished
         model.peewee_db.close()
         self.controller.set_status(500)
@@ -230,7 +297,137 @@ class TestBase(BaseMockController):
         self.controller.session["test key"] = "test value" + UCHAR
         self.controller.saveSession()
         assert self.name == 'session'
-        assert self.data == json.dumps({"test key": "test value" + UCHAR})
+        assert self.data == b'j{"test key":"test value' + UCHAR.encode('utf8') + b'"}'
+
+        # nothing is written again unless something changes
+        self.name = self.data = None
+        self.controller.session["test key"] = "test value" + UCHAR
+        self.controller.saveSession()
+        assert self.name is None
+
+    @async_test
+    async def test_sessionStore(self):
+        orig_store = controller_base.sessions.STORE
+        store = controller_base.sessions.STORE = controller_base.sessions.MemorySessionStore()
+        try:
+            await self.controller.prepare()
+            self.controller.session['form_data'] = {'field': 'value' * 100}
+            self.controller.saveSession()
+
+            # the cookie only has the id, and the data is kept in the store
+            assert 'session' not in self.controller._new_cookie
+            sid = self.controller._new_cookie['sid'].value
+            assert len(sid) < 50
+            assert controller_base.Session.decode(store.load(sid)) == {'form_data': {'field': 'value' * 100}}
+
+            # the next request reads it back
+            cookies = {'sid': sid}
+            self.controller.get_cookie = lambda name, default=None: cookies.get(name, default)
+            self.controller.prepareSession()
+            assert self.controller.session.pop('form_data') == {'field': 'value' * 100}
+            assert self.controller.session_id == sid
+
+            # and an empty session doesn't need to be stored
+            self.controller.saveSession()
+            assert store.load(sid) is None
+
+            # an id that isn't in the store is replaced rather than used
+            cookies['sid'] = 'made up'
+            self.controller.prepareSession()
+            self.controller.flash('test flash')
+            self.controller.saveSession()
+            assert store.load('made up') is None
+            assert self.controller._new_cookie['sid'].value != 'made up'
+            assert store.load(self.controller.session_id)
+        finally:
+            controller_base.sessions.STORE = orig_store
+
+    @async_test
+    async def test_sessionLazy(self):
+        calls = []
+        orig_decode = controller_base.web.decode_signed_value
+
+        def decode_signed_value(*args, **kwargs):
+            calls.append(args[1])
+            return orig_decode(*args, **kwargs)
+
+        controller_base.web.decode_signed_value = decode_signed_value
+        try:
+            # a request that never reads the session doesn't verify its cookie
+            self.controller.request.headers['Cookie'] = 'session=' + self.controller.create_signed_value('session',
+                controller_base.Session.encode({'flash': 'hi'})).decode()
+            await self.controller.prepare()
+            assert calls == []
+
+            # and one that does only verifies it once
+            assert self.controller.session.get('flash') == 'hi'
+            assert self.controller.session.get('flash') == 'hi'
+            assert self.controller.get_secure_cookie('session') == b'j{"flash":"hi"}'
+            assert calls == ['session']
+            assert not self.controller.session.dirty
+        finally:
+            controller_base.web.decode_signed_value = orig_decode
+
+    @async_test
+    async def test_route(self):
+        model.replica_db = model.makeReplica(model.constants.DB_HOST)
+        try:
+            # read only requests can use the replica
+            self.controller.request.method = 'GET'
+            await self.controller.prepare()
+            assert model.ROUTE.get().replica
+
+            # but not for a little while after writing something
+            self.createAccount()
+            assert model.ROUTE.get().wrote
+            self.controller.saveSession()
+            last_write = self.controller._new_cookie['last_write']
+            assert int(last_write.value) > 0
+            assert last_write['max-age'] == model.Replica.STICKY_SECONDS
+
+            # send the cookie from above back with the next request
+            cookies = {'last_write': last_write.value}
+            self.controller.get_cookie = lambda name, default=None: cookies.get(name, default)
+            await self.controller.prepare()
+            assert not model.ROUTE.get().replica
+
+            cookies['last_write'] = str(int(last_write.value) - model.Replica.STICKY_SECONDS)
+            await self.controller.prepare()
+            assert model.ROUTE.get().replica
+
+            self.controller.request.method = 'POST'
+            await self.controller.prepare()
+            assert not model.ROUTE.get().replica
+
+            self.controller.on_finish()
+            assert model.replica_db.is_closed()
+            assert model.ROUTE.get() is None
+        finally:
+            model.replica_db.close()
+            model.replica_db = None
+
+    @async_test
+    async def test_queryStats(self):
+        account = self.createAccount()
+        self.controller.request.method = 'GET'
+        await self.controller.prepare()
+        assert model.QUERIES.get() is self.controller.query_stats
+
+        for i in range(model.constants.DB_QUERY_REPEAT_WARNING + 1):
+            model.Account.getByEmail(account.email)
+        assert self.controller.query_stats.count == model.constants.DB_QUERY_REPEAT_WARNING + 1
+
+        # debug mode shows the timing to anyone
+        self.controller._transforms = []
+        self.controller.finish()
+        assert self.controller._headers['Server-Timing'].startswith('db;dur=')
+        assert self.controller._headers['Server-Timing'].endswith(';desc="11 queries"')
+
+        with self.assertLogs('tornado.application', level='WARNING') as logs:
+            self.controller.on_finish()
+        assert len(logs.output) == 1
+        assert 'Query ran 11 times in GET /test-path' in logs.output[0]
+        assert model.QUERIES.get() is None
 
     def test_logger(self):
         logger = self.controller.logger
@@ -400,6 +597,23 @@ class TestBase(BaseMockController):
         assert self.controller.current_user is not None
         assert self.controller.current_user.id == account.id
 
+        # during a request the account and its auth come back in one query, and aren't fetched again after that
+        model.IdentityMap.start()
+        stats = model.QueryStats.start()
+        try:
+            controller_base.helpers.clear_cache()
+            self.controller.current_user = self.controller.get_current_user()
+            assert model.Account.getBySlug(account.id) is self.controller.current_user
+            assert model.Auth.getBySlug(auth.id).account is self.controller.current_user
+            assert stats.count == 1
+
+            # and the auth is marked as still in use, without writing anything yet
+            assert auth.id in model.AuthTouches.pending
+        finally:
+            model.IDENTITIES.set(None)
+            model.QUERIES.set(None)
+            model.AuthTouches.pending = {}
+
         self.controller.get_secure_cookie = orig_cookie
 
     def test_deferEmail(self):
@@ -625,6 +839,61 @@ class TestSitemap(BaseTestController):
         assert response.headers.get('Content-Type') == 'application/xml'
 
 
+class TestCachedPages(BaseTestController):
+
+    def get_app(self):
+        # pages are only cached outside of debug mode
+        from main import makeApp
+        return makeApp(level=logging.CRITICAL)
+
+    def fetchRaw(self, url, headers):
+        # the normal fetch decodes the body, but we want to check the compressed bytes here
+        return AsyncHTTPTestCase.fetch(self, url, headers=headers, decompress_response=False)
+
+    def test_cachedPage(self):
+        response = self.fetchRaw('/terms', {'Accept-Encoding': 'gzip'})
+        assert response.code == 200
+        assert response.headers.get('Content-Encoding') == 'gzip'
+        etag = response.headers.get('Etag')
+        assert etag.endswith('-gzip"')
+        assert not response.headers.get('Server-Timing') # only shown to developers outside of debug
+        assert gzip.decompress(response.body).startswith(b'<!doctype html>')
+
+        # the cached version is identical and honors conditional requests
+        response = self.fetchRaw('/terms', {'Accept-Encoding': 'gzip'})
+        assert response.headers.get('Etag') == etag
+
+        response = self.fetch('/terms', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        assert response.code == 304
+        assert not response.body
+
+        # clients that don't accept compression get the plain version with its own tag
+        response = self.fetchRaw('/terms', {})
+        assert response.code == 200
+        assert not response.headers.get('Content-Encoding')
+        assert response.headers.get('Etag') != etag
+        assert response.body.startswith(b'<!doctype html>')
+
+        # not found pages are cached but keep their status
+        response = self.fetch('/does-not-exist')
+        assert response.code == 404
+        response = self.fetch('/does-not-exist')
+        assert response.code == 404
+
+    def test_warmCache(self):
+        import helpers
+        from main import warmCache
+
+        total = self.io_loop.run_sync(lambda: warmCache(self._app))
+
+        # pages with path parameters, like the 404 catch all, can't be rendered ahead of time
+        assert total == 4
+        for path in ['/', '/terms', '/privacy', '/sitemap.xml']:
+            page = helpers.CACHE.get(path)
+            assert page
+            assert page.status == 200
+
+
 class TestStatic(BaseTestController):
 
     def test_static(self):
@@ -665,6 +934,7 @@ class TestAccount(BaseTestController):
 
         response = self.sessionGet('/account/auths')
         assert '<h2>Active Sessions</h2>' in response.body_string
+        assert response.headers.get('Server-Timing').startswith('db;dur=')
         assert account_auth.modified_dt.isoformat() in response.body_string
         assert self.other_auth.modified_dt.isoformat() not in response.body_string
         assert 'Current Session' in response.body_string
@@ -939,6 +1209,13 @@ class TestDev(BaseTestController):
 
         response = self.sessionGet('/dev')
         assert '<h2>Dev</h2>' in response.body_string
+        assert '<h3>Cache</h3>' in response.body_string
+
+        # cache stats are also available in a machine readable format
+        response = self.sessionGet('/dev?app=1')
+        data = json.loads(response.body_string)
+        assert 'hit_rate' in data['cache']
+        assert 'auth_' in data['cache']['prefixes']
 
         # test clearing memcache out
         response = self.sessionPost('/dev', {'clear_cache': '1'})
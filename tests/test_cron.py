@@ -1,8 +1,9 @@
 from datetime import datetime, timedelta
 
 from _base import BaseTestCase
-from cron import AuthCron
+from cron import AuthCron, SessionCron
 import model
+import sessions
 
 
 class TestCron(BaseTestCase):
@@ -21,3 +22,74 @@ class TestCron(BaseTestCase):
         AuthCron.run()
         assert model.Auth.select().count() == 1
         assert auth.id == model.Auth.select().first().id
+
+    def test_authPartitions(self):
+        # a partition that's entirely older than the cutoff is dropped rather than deleted from
+        old_dt = datetime.utcnow() - timedelta(days=AuthCron.MAX_DAYS + 7)
+        old_partition = model.Auth.partitionName(model.Auth.partitionStart(old_dt))
+        model.Auth.addPartition(model.Auth.partitionStart(old_dt))
+
+        self.createAuth()
+        auth = self.createAuth()
+        auth.modified_dt = old_dt
+        super(model.BaseModel, auth).save()
+
+        # the future partitions are kept rolling forward as well
+        ahead = timedelta(days=(model.Auth.PARTITIONS_AHEAD + 1) * 7)
+        next_partition = model.Auth.partitionName(model.Auth.partitionStart(datetime.utcnow()) + ahead)
+        orig = model.Auth.PARTITIONS_AHEAD
+        model.Auth.PARTITIONS_AHEAD += 1
+        try:
+            AuthCron.run()
+        finally:
+            model.Auth.PARTITIONS_AHEAD = orig
+
+        partitions = model.Auth.partitions()
+        assert old_partition not in partitions
+        assert next_partition in partitions
+        assert model.Auth.select().count() == 1
+
+    def test_authPartitionLocked(self):
+        # a partition that can't be detached right away is left for the next run, and the rest of the job still runs
+        old_dt = datetime.utcnow() - timedelta(days=AuthCron.MAX_DAYS + 7)
+        old_partition = model.Auth.partitionName(model.Auth.partitionStart(old_dt))
+        model.Auth.addPartition(model.Auth.partitionStart(old_dt))
+
+        self.createAuth()
+        auth = self.createAuth()
+        auth.modified_dt = old_dt
+        super(model.BaseModel, auth).save()
+
+        # another connection in the middle of reading from the table
+        connection = model.newConnection()
+        orig = model.Auth.DETACH_LOCK_TIMEOUT
+        model.Auth.DETACH_LOCK_TIMEOUT = '10ms'
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('LOCK TABLE "auth" IN ACCESS SHARE MODE')
+            with self.assertLogs(level='WARNING'):
+                assert AuthCron.run() == 1
+            assert model.peewee_db.is_closed()
+        finally:
+            model.Auth.DETACH_LOCK_TIMEOUT = orig
+            connection.close()
+
+        assert old_partition in model.Auth.partitions()
+        assert model.Auth.select().count() == 1
+
+    def test_session(self):
+        store = sessions.PostgresSessionStore()
+        store.save('current', b'jnew', 60)
+        store.save('expired', b'jold', -1)
+
+        # nothing to do unless sessions are stored in postgres
+        assert SessionCron.run() == 0
+
+        orig_store = sessions.STORE
+        sessions.STORE = store
+        try:
+            assert SessionCron.run() == 1
+        finally:
+            sessions.STORE = orig_store
+
+        assert [row.id for row in model.SessionData.select()] == ['current']
@@ -1,4 +1,18 @@
+import json
+import time
+import unittest
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
 from _base import BaseTestCase
+import model
+from _memcache import MemcacheServer
+
+try:
+    import memcache
+except ImportError:
+    memcache = None
 
 
 class TestHelpers(BaseTestCase):
@@ -163,3 +177,446 @@ class TestHelpers(BaseTestCase):
         result = self.helpers.cache("test key", testFunction)
         assert result is True
         assert self.executed == 2
+
+    def test_lru_cache(self):
+        lru = self.helpers.LRUCache(max_size=3, max_bytes=10000, max_item_bytes=1000)
+
+        lru.set("one", 1)
+        lru.set("two", 2)
+        lru.set("three", 3)
+        assert len(lru) == 3
+
+        # using a key moves it to the end so it's the last to be evicted
+        assert lru.get("one") == 1
+
+        lru.set("four", 4)
+        assert len(lru) == 3
+        assert "two" not in lru
+        assert "one" in lru
+        assert "four" in lru
+
+        # values that are too big are never stored
+        assert not lru.set("big", "x" * 2000)
+        assert "big" not in lru
+        assert len(lru) == 3
+
+        # the total size in bytes is tracked through updates and deletes
+        lru.clear()
+        assert lru.bytes == 0
+        lru.set("one", "a")
+        size = lru.bytes
+        assert size > 0
+        lru.set("one", "a")
+        assert lru.bytes == size
+        lru.delete("one")
+        assert lru.bytes == 0
+
+        # the byte limit evicts the least recently used entries to make room
+        lru = self.helpers.LRUCache(max_size=100, max_bytes=self.helpers.sizeof("x" * 100) * 2, max_item_bytes=1000)
+        lru.set("one", "x" * 100)
+        lru.set("two", "x" * 100)
+        lru.set("three", "x" * 100)
+        assert "one" not in lru
+        assert "two" in lru
+        assert "three" in lru
+
+    def test_lru_cache_expires(self):
+        lru = self.helpers.LRUCache()
+
+        lru.set("test key", "value", expires=0.1)
+        assert lru.get("test key") == "value"
+        assert lru.getStale("test key") == ("value", False)
+
+        time.sleep(0.2)
+        # an expired value can still be read as stale until a regular get removes it
+        assert lru.getStale("test key") == ("value", True)
+        assert lru.get("test key") is None
+        assert "test key" not in lru
+        assert lru.bytes == 0
+
+    def test_cache_stats(self):
+        stats = self.helpers.STATS
+
+        self.helpers.cache("auth_1", lambda: "account")
+        self.helpers.cache("auth_1", lambda: "account")
+        self.helpers.cache("auth_2", lambda: "other account")
+        self.helpers.cache("/page", lambda: "x" * 1000)
+
+        assert stats.hits == 1
+        assert stats.misses == 3
+        assert stats.fills == 3
+
+        data = stats.toDict()
+        assert data['hit_rate'] == 0.25
+        assert data['entries'] == 3
+        assert data['prefixes']['auth_'] == {'hits': 1, 'misses': 2, 'entries': 2,
+            'bytes': self.helpers.sizeof("account") + self.helpers.sizeof("other account")}
+        assert data['prefixes']['/']['entries'] == 1
+        assert data['top_by_size'][0]['key'] == "/page"
+        assert data['top_by_hits'][0] == {'key': "auth_1", 'bytes': self.helpers.sizeof("account"), 'hits': 1}
+
+        # evictions are counted by the LRU itself
+        lru = self.helpers.LRUCache(max_size=1)
+        lru.set("one", 1)
+        lru.set("two", 2)
+        assert lru.evictions == 1
+
+        self.helpers.clear_cache()
+        assert stats.toDict()['hits'] == 0
+
+    def test_cache_revalidate(self):
+        self.executed = 0
+
+        def testFunction():
+            self.executed += 1
+            return "test value " + str(self.executed)
+
+        async def run():
+            result = self.helpers.cache("test key", testFunction, expires=0.1, revalidate=True)
+            assert result == "test value 1"
+
+            time.sleep(0.2)
+
+            # the stale value is served immediately while a refresh is scheduled only once
+            result = self.helpers.cache("test key", testFunction, expires=0.1, revalidate=True)
+            assert result == "test value 1"
+            result = self.helpers.cache("test key", testFunction, expires=0.1, revalidate=True)
+            assert result == "test value 1"
+            assert len(self.helpers.REVALIDATING) == 1
+
+            # give the background refresh a chance to finish
+            while self.helpers.REVALIDATING:
+                await gen.sleep(0.01)
+
+            result = self.helpers.cache("test key", testFunction, expires=0.1, revalidate=True)
+            assert result == "test value 2"
+            assert self.executed == 2
+
+        loop = IOLoop()
+        try:
+            loop.run_sync(run)
+        finally:
+            loop.close()
+
+        # without a loop running the expired value is recomputed inline
+        time.sleep(0.2)
+        result = self.helpers.cache("test key", testFunction, expires=0.1, revalidate=True)
+        assert result == "test value 3"
+
+    def test_minifyTemplate(self):
+        source = """<p class="test">
+            <input type="checkbox" {{ 'checked' if checked else '' }}>
+            <!-- removed -->
+            {% if value %}   <span title="{{ value }}">  {{ value }}  </span>   {% end %}
+        </p>"""
+
+        result = self.helpers.minifyTemplate(source)
+        assert result == ('<p class="test"><input type="checkbox" {{ \'checked\' if checked else \'\' }}> '
+            '{% if value %} <span title="{{ value }}"> {{ value }} </span> {% end %} </p>')
+
+    def test_cacheAndRender(self):
+        self.executed = 0
+
+        class MockRequest(object):
+            path = '/test-path'
+            query = ''
+            method = 'GET'
+            headers = {}
+
+        class MockController(object):
+            debug = False
+            request = MockRequest()
+            settings = {'compress_response': True}
+
+            def __init__(self):
+                self._write_buffer = []
+                self._headers = {}
+                self._status = 200
+
+            def get_status(self):
+                return self._status
+
+            def set_status(self, status):
+                self._status = status
+
+            def set_header(self, name, value):
+                self._headers[name] = value
+
+            def check_etag_header(self):
+                return False
+
+            def write(self, chunk):
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                self._write_buffer.append(chunk)
+
+        @self.helpers.cacheAndRender()
+        async def get(controller):
+            self.executed += 1
+            # yield to the loop like a real action waiting on something would
+            await gen.sleep(0.01)
+            controller.write('<p>test page</p>')
+
+        async def run():
+            controllers = [MockController() for i in range(3)]
+            await gen.multi([get(controller) for controller in controllers])
+            return controllers
+
+        loop = IOLoop()
+        try:
+            controllers = loop.run_sync(run)
+        finally:
+            loop.close()
+
+        # concurrent requests for the same page only render it once
+        assert self.executed == 1
+        assert not self.helpers.RENDERING
+        assert self.helpers.CACHE.get('/test-path').body == b'<p>test page</p>'
+        for controller in controllers:
+            assert controller._write_buffer == [b'<p>test page</p>']
+            assert controller._headers['Etag'] == '"' + self.helpers.CACHE.get('/test-path').etag + '"'
+
+        # a render that doesn't end with a page to cache hands over to one of the waiting requests at a time
+        MockRequest.path = '/test-failing'
+        self.executed = 0
+
+        @self.helpers.cacheAndRender()
+        async def failing(controller):
+            self.executed += 1
+            await gen.sleep(0.01)
+            if self.executed == 1:
+                controller.set_status(302)
+            elif self.executed == 2:
+                raise ValueError('test error')
+            else:
+                controller.write('<p>test page</p>')
+
+        async def attempt(controller):
+            try:
+                await failing(controller)
+            except ValueError as e:
+                return e
+
+        async def runFailing():
+            controllers = [MockController() for i in range(4)]
+            results = await gen.multi([attempt(controller) for controller in controllers])
+            return controllers, results
+
+        loop = IOLoop()
+        try:
+            controllers, results = loop.run_sync(runFailing)
+        finally:
+            loop.close()
+
+        assert self.executed == 3
+        assert not self.helpers.RENDERING
+        assert results[0] is None
+        assert isinstance(results[1], ValueError)
+        assert results[2:] == [None, None]
+        assert controllers[0].get_status() == 302
+        assert controllers[0]._write_buffer == []
+        for controller in controllers[2:]:
+            assert controller._write_buffer == [b'<p>test page</p>']
+
+
+@unittest.skipUnless(memcache, 'python-memcached is not installed')
+class TestCacheBackends(BaseTestCase):
+
+    def setUp(self):
+        super(TestCacheBackends, self).setUp()
+        import helpers
+        self.helpers = helpers
+
+        self.server = MemcacheServer().start()
+        self.client = memcache.Client([self.server.address])
+        self.l2 = helpers.MemcacheBackend(self.client)
+
+    def tearDown(self):
+        super(TestCacheBackends, self).tearDown()
+        self.client.disconnect_all()
+        self.server.stop()
+
+    def test_memcache(self):
+        assert self.l2.get("test_key") is None
+        assert self.l2.get("test_key", "default") == "default"
+
+        self.l2.set("test_key", {"test": "value"})
+        assert self.l2.get("test_key") == {"test": "value"}
+
+        self.l2.delete("test_key")
+        assert self.l2.get("test_key") is None
+
+        self.l2.set("test_key", "value", expires=1)
+        assert self.l2.get("test_key") == "value"
+        time.sleep(1.1)
+        assert self.l2.get("test_key") is None
+
+        self.l2.set("test_key", "value")
+        self.l2.clear()
+        assert self.l2.get("test_key") is None
+
+    def test_cachedPage(self):
+        # rendered pages go through memcache too, which pickles them
+        page = self.helpers.CachedPage(b'<p>page</p>', status=404, content_type='text/html')
+        tiered = self.helpers.TieredCache(self.helpers.LRUCache(), self.l2)
+        tiered.set('/page', page)
+
+        cached = self.l2.get('/page')
+        assert cached is not page
+        for name in self.helpers.CachedPage.__slots__:
+            assert getattr(cached, name) == getattr(page, name)
+
+    def test_tiered(self):
+        tiered = self.helpers.TieredCache(self.helpers.LRUCache(), self.l2)
+
+        # another process filling the shared L2 is picked up and then served from the local L1
+        self.l2.set("test_key", "value")
+        assert tiered.get("test_key") == "value"
+        assert tiered.l1.get("test_key") == "value"
+
+        self.server.flush()
+        assert tiered.get("test_key") == "value"
+
+        # writes and deletes go through to both tiers
+        tiered.set("other_key", "other value")
+        assert self.l2.get("other_key") == "other value"
+        assert tiered.l1.get("other_key") == "other value"
+
+        tiered.delete("other_key")
+        assert self.l2.get("other_key") is None
+        assert tiered.l1.get("other_key") is None
+
+        # copies in the L1 expire on their own so other processes' changes get picked up eventually
+        tiered = self.helpers.TieredCache(self.helpers.LRUCache(), self.l2, l1_expires=0.1)
+        self.l2.set("expiring_key", "value")
+        assert tiered.get("expiring_key") == "value"
+        self.l2.set("expiring_key", "new value")
+        assert tiered.get("expiring_key") == "value"
+        time.sleep(0.2)
+        assert tiered.get("expiring_key") == "new value"
+
+    def test_cache(self):
+        orig_cache = self.helpers.CACHE
+        self.helpers.CACHE = self.helpers.makeCache(self.client)
+        self.executed = 0
+
+        def testFunction():
+            self.executed += 1
+            return "test value"
+
+        try:
+            assert self.helpers.cache("test key", testFunction) == "test value"
+            assert self.helpers.cache("test key", testFunction) == "test value"
+            assert self.executed == 1
+
+            # the key is made memcache compatible before it's stored
+            assert self.l2.get("test_key") == "test value"
+
+            self.helpers.uncache("test key")
+            assert self.l2.get("test_key") is None
+            assert self.helpers.cache("test key", testFunction) == "test value"
+            assert self.executed == 2
+        finally:
+            self.helpers.CACHE = orig_cache
+
+
+class TestCacheBus(BaseTestCase):
+
+    def setUp(self):
+        super(TestCacheBus, self).setUp()
+        import helpers
+        self.helpers = helpers
+        self.loop = IOLoop()
+        self.loop.make_current()
+
+    def tearDown(self):
+        self.helpers.CacheBus.stop()
+        self.loop.clear_current()
+        self.loop.close()
+        super(TestCacheBus, self).tearDown()
+
+    def notify(self, payload):
+        model.peewee_db.execute_sql('SELECT pg_notify(%s, %s)', (self.helpers.CacheBus.CHANNEL, json.dumps(payload)))
+
+    def test_apply(self):
+
+        async def waitFor(condition):
+            for i in range(100):
+                if condition():
+                    return
+                await gen.sleep(0.01)
+            assert False, 'Timed out waiting for the cache bus'
+
+        async def run():
+            self.helpers.CacheBus.start(model.newConnection)
+
+            # a message from another process removes the key here
+            self.helpers.cache("test_key", lambda: "value")
+            self.notify({'origin': 'other', 'action': 'delete', 'key': 'test_key'})
+            await waitFor(lambda: "test_key" not in self.helpers.CACHE)
+
+            self.helpers.cache("test_key", lambda: "value")
+            self.notify({'origin': 'other', 'action': 'clear', 'key': None})
+            await waitFor(lambda: len(self.helpers.CACHE) == 0)
+
+            # messages that this process sent have already been applied, so they're skipped
+            self.helpers.cache("test_key", lambda: "value")
+            self.notify({'origin': self.helpers.CacheBus.ORIGIN, 'action': 'clear', 'key': None})
+            self.notify({'origin': 'other', 'action': 'delete', 'key': 'other_key'})
+            await gen.sleep(0.1)
+            assert "test_key" in self.helpers.CACHE
+
+        self.loop.run_sync(run)
+
+    def test_reconnect(self):
+        CacheBus = self.helpers.CacheBus
+
+        async def run():
+            CacheBus.start(model.newConnection)
+            lost = CacheBus.CONNECTION
+            with self.assertLogs(CacheBus.LOGGER, level='ERROR'):
+                model.peewee_db.execute_sql('SELECT pg_terminate_backend(%s)', (lost.get_backend_pid(),))
+                for i in range(100):
+                    if CacheBus.CONNECTION is not lost:
+                        break
+                    await gen.sleep(0.01)
+
+            # the broken connection was closed (rather than only marked broken) before connecting again
+            assert lost.closed == 1
+            assert CacheBus.CONNECTION is not lost
+            assert not CacheBus.CONNECTION.closed
+
+        orig_delay = CacheBus.RECONNECT_DELAY
+        CacheBus.RECONNECT_DELAY = 0.01
+        try:
+            self.loop.run_sync(run)
+        finally:
+            CacheBus.RECONNECT_DELAY = orig_delay
+
+    def test_publish(self):
+        listener = model.newConnection()
+        listener.autocommit = True
+        try:
+            with listener.cursor() as cursor:
+                cursor.execute('LISTEN ' + self.helpers.CacheBus.CHANNEL)
+
+            # without the bus started nothing is sent
+            self.helpers.uncache("test key")
+            listener.poll()
+            assert not listener.notifies
+
+            self.helpers.CacheBus.start(model.newConnection)
+            self.helpers.uncache("test key")
+            self.helpers.clear_cache()
+
+            for i in range(100):
+                listener.poll()
+                if len(listener.notifies) >= 2:
+                    break
+                time.sleep(0.01)
+
+            messages = [json.loads(notify.payload) for notify in listener.notifies]
+            assert messages[0] == {'origin': self.helpers.CacheBus.ORIGIN, 'action': 'delete', 'key': 'test_key'}
+            assert messages[1] == {'origin': self.helpers.CacheBus.ORIGIN, 'action': 'clear', 'key': None}
+        finally:
+            listener.close()
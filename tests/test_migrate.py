@@ -0,0 +1,160 @@
+from datetime import datetime, timedelta
+
+from _base import BaseTestCase
+from cron import AuthCron
+import migrate
+import model
+
+
+class TestMigrate(BaseTestCase):
+
+    def setUp(self):
+        super(TestMigrate, self).setUp()
+        self.connection = model.newConnection()
+        self.connection.autocommit = True
+
+    def tearDown(self):
+        self.connection.close()
+        super(TestMigrate, self).tearDown()
+
+    def indexNames(self, table):
+        cursor = self.connection.cursor()
+        names = migrate.existingIndexes(cursor, table)
+        cursor.close()
+        return names
+
+    def test_indexSQL(self):
+        index = model.Auth._meta.fields_to_index()[-1]
+        sql, params = migrate.indexSQL(index)
+        assert sql == 'CREATE INDEX CONCURRENTLY IF NOT EXISTS "auth_account_id_user_agent" ON "auth" ' \
+            '("account_id", "user_agent")'
+        assert params == []
+
+    def test_syncIndexes(self):
+        # everything is already created by reset
+        assert migrate.syncIndexes(self.connection) == []
+
+        model.peewee_db.execute_sql('DROP INDEX auth_modified_dt')
+        model.peewee_db.execute_sql('DROP INDEX account_email')
+        model.peewee_db.commit()
+        assert 'auth_modified_dt' not in self.indexNames('auth')
+
+        # a dry run only reports what's missing
+        assert migrate.syncIndexes(self.connection, dry_run=True) == ['account_email', 'auth_modified_dt']
+        assert 'auth_modified_dt' not in self.indexNames('auth')
+
+        assert migrate.syncIndexes(self.connection) == ['account_email', 'auth_modified_dt']
+        assert 'auth_modified_dt' in self.indexNames('auth')
+        assert 'account_email' in self.indexNames('account')
+
+        # auth is partitioned, so its index is built on each partition and attached to the parent
+        for partition in model.Auth.partitions():
+            assert 'auth_modified_dt_' + partition in self.indexNames(partition)
+
+        cursor = self.connection.cursor()
+        assert migrate.invalidIndexes(cursor) == set()
+        cursor.close()
+
+        assert migrate.syncIndexes(self.connection) == []
+
+    def test_syncIndexesInvalid(self):
+        # a failed concurrent build leaves the index in place but marked invalid
+        self.createAccount(email='first@example.com')
+        self.createAccount(email='second@example.com')
+        cursor = self.connection.cursor()
+        cursor.execute('DROP INDEX account_email')
+        try:
+            cursor.execute('CREATE UNIQUE INDEX CONCURRENTLY account_email ON account (is_admin)')
+        except Exception:
+            pass
+        assert migrate.invalidIndexes(cursor) == {'account_email'}
+
+        assert migrate.syncIndexes(self.connection) == ['account_email']
+        assert migrate.invalidIndexes(cursor) == set()
+
+        # an interrupted partitioned build leaves the parent index invalid until every partition is attached
+        cursor.execute('DROP INDEX auth_modified_dt')
+        cursor.execute('CREATE INDEX auth_modified_dt ON ONLY auth (modified_dt)')
+        assert migrate.invalidIndexes(cursor) == {'auth_modified_dt'}
+
+        assert migrate.syncIndexes(self.connection) == ['auth_modified_dt']
+        assert migrate.invalidIndexes(cursor) == set()
+        cursor.close()
+
+    def test_runMigrations(self):
+        calls = []
+
+        def first():
+            calls.append('first')
+
+        def second():
+            calls.append('second')
+
+        ran = migrate.runMigrations([('0001_first', first)], dry_run=True)
+        assert ran == ['0001_first']
+        assert calls == []
+
+        ran = migrate.runMigrations([('0001_first', first)])
+        assert ran == ['0001_first']
+        assert calls == ['first']
+        assert model.Migration.select().count() == 1
+
+        # only new migrations run after that
+        ran = migrate.runMigrations([('0001_first', first), ('0002_second', second)])
+        assert ran == ['0002_second']
+        assert calls == ['first', 'second']
+
+    def test_migrate(self):
+        model.peewee_db.execute_sql('DROP INDEX auth_account_id_user_agent')
+        model.peewee_db.commit()
+
+        # one time migrations are only run when asked for
+        with self.assertLogs(level='WARNING'):
+            created, ran = migrate.migrate()
+        assert created == ['auth_account_id_user_agent']
+        assert ran == []
+        assert 'auth_account_id_user_agent' in self.indexNames('auth')
+        assert model.Migration.select().count() == 0
+
+        # already partitioned by reset, so this only gets recorded
+        assert migrate.migrate(migrations=True) == ([], ['0001_partition_auth'])
+        assert migrate.migrate(migrations=True) == ([], [])
+
+    def createUnpartitionedAuth(self):
+        # recreate the auth table the way it was before it was partitioned
+        account = self.createAccount()
+        model.peewee_db.execute_sql('DROP TABLE auth')
+        model.peewee_db.execute_sql('CREATE TABLE auth (id SERIAL NOT NULL PRIMARY KEY, created_dt TIMESTAMP NOT NULL, '
+            'modified_dt TIMESTAMP NOT NULL, user_agent VARCHAR(255) NOT NULL, os VARCHAR(255), '
+            'browser VARCHAR(255), device VARCHAR(255), ip VARCHAR(255) NOT NULL, '
+            'account_id INTEGER NOT NULL REFERENCES account (id))')
+        model.peewee_db.execute_sql('CREATE INDEX auth_account_id ON auth (account_id)')
+
+        now = datetime.utcnow()
+        old_dt = now - timedelta(days=AuthCron.MAX_DAYS + 1)
+        for dt in [old_dt, now, now]:
+            model.peewee_db.execute_sql('INSERT INTO auth (created_dt, modified_dt, user_agent, ip, account_id) '
+                "VALUES (%s, %s, 'agent', '127.0.0.1', %s)", (dt, dt, account.id))
+        model.peewee_db.commit()
+
+    def test_migrateUnpartitioned(self):
+        # the old table is replaced before indexes are synced, so they're only built on the new one
+        self.createUnpartitionedAuth()
+        assert migrate.migrate(migrations=True) == ([], ['0001_partition_auth'])
+        assert 'auth_modified_dt' in self.indexNames('auth')
+        assert model.Auth.select().count() == 2
+
+    def test_partitionAuth(self):
+        self.createUnpartitionedAuth()
+        migrate.partitionAuth()
+
+        assert len(model.Auth.partitions()) == model.Auth.PARTITIONS_AHEAD + 2
+        assert [auth.id for auth in model.Auth.select().order_by(model.Auth.id)] == [2, 3]
+        assert 'auth_account_id_user_agent' in self.indexNames('auth')
+
+        # new auths carry on from the old ids
+        assert self.createAuth().id == 4
+
+        # running it again does nothing
+        migrate.partitionAuth()
+        assert model.Auth.select().count() == 3
@@ -1,9 +1,21 @@
-from datetime import datetime
+from datetime import date, datetime, timedelta
+import hashlib
+import threading
+import time
 
-from _base import BaseTestCase, UCHAR # this MUST come before model import to set up test DB properly
+import psycopg2
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from _base import async_test, BaseTestCase, UCHAR # this MUST come before model import to set up test DB properly
 
 import model
 
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
 
 class TestBaseModel(BaseTestCase):
 
@@ -22,6 +34,550 @@ class TestBaseModel(BaseTestCase):
         # TODO
         pass
 
+    def test_deleteInBatches(self):
+        auths = [self.createAuth() for i in range(7)]
+        old_dt = datetime.utcnow() - timedelta(days=2)
+        for auth in auths[:5]:
+            auth.modified_dt = old_dt
+            super(model.BaseModel, auth).save()
+
+        # five old auths in batches of two take three short transactions
+        where = model.Auth.modified_dt < datetime.utcnow() - timedelta(days=1)
+        with self.assertLogs(level='INFO') as logs:
+            total = model.Auth.deleteInBatches(where, batch_size=2, pause=0)
+        assert total == 5
+        assert len([line for line in logs.output if 'Batch ' in line]) == 3
+
+        remaining = [auth.id for auth in model.Auth.select().order_by(model.Auth.id)]
+        assert remaining == [auth.id for auth in auths[5:]]
+
+        assert model.Auth.deleteInBatches(where, batch_size=2, pause=0) == 0
+
+
+class TestPool(BaseTestCase):
+
+    def test_warmPool(self):
+        model.peewee_db.close_idle()
+        model.warmPool(2)
+
+        # the warmed connections are waiting in the pool, not held by this thread
+        assert len(model.peewee_db._connections) == 2
+        assert not model.peewee_db.is_closed()
+
+        # borrowing one in another thread reuses a warm connection instead of opening a new one
+        def borrow():
+            with model.peewee_db.connection_context():
+                assert len(model.peewee_db._connections) == 1
+
+        thread = threading.Thread(target=borrow)
+        thread.start()
+        thread.join()
+        assert len(model.peewee_db._connections) == 2
+
+        model.peewee_db.close_idle()
+
+
+class TestDatabaseExecutor(BaseTestCase):
+
+    def test_run(self):
+        executor = model.DatabaseExecutor(max_workers=1, max_queue=1)
+        release = threading.Event()
+
+        def block():
+            release.wait(5)
+            return model.Account.select().count()
+
+        async def run():
+            # one running and one waiting fills it up, so the next call is rejected right away
+            first = gen.convert_yielded(executor.run(block))
+            second = gen.convert_yielded(executor.run(block))
+            await gen.sleep(0)
+            assert executor.pending == 2
+            assert executor.toDict()['queued'] == 1
+
+            try:
+                await executor.run(block)
+            except model.DatabaseBusy:
+                pass
+            else:
+                assert False
+
+            release.set()
+            assert await first == 0
+            assert await second == 0
+
+        loop = IOLoop()
+        try:
+            loop.run_sync(run)
+        finally:
+            loop.close()
+
+        stats = executor.toDict()
+        assert stats['submitted'] == 2
+        assert stats['completed'] == 2
+        assert stats['rejected'] == 1
+        assert stats['pending'] == 0
+        assert stats['run_ms_max'] > 0
+
+    @async_test
+    async def test_async_db(self):
+        self.createAccount()
+        assert await model.async_db(model.Account.select().count) == 1
+
+
+class TestReplica(BaseTestCase):
+
+    def setUp(self):
+        super(TestReplica, self).setUp()
+        # the test database stands in for its own replica, which always looks caught up
+        model.replica_db = model.makeReplica(model.constants.DB_HOST)
+        model.Replica.healthy = False
+        model.Replica.checked_at = 0
+        model.Replica.check_after = 0
+
+    def tearDown(self):
+        model.replica_db.close()
+        model.replica_db = None
+        model.ROUTE.set(None)
+        super(TestReplica, self).tearDown()
+
+    def test_database(self):
+        # outside of a request everything uses the primary
+        assert model.Replica.database() is model.peewee_db
+
+        model.Replica.route(replica=False)
+        assert model.Replica.database() is model.peewee_db
+
+        # and so does a request that could use the replica until it has been checked
+        route = model.Replica.route(replica=True)
+        assert model.Replica.database() is model.peewee_db
+        model.Replica.check()
+        assert model.Replica.lag == 0
+        assert model.Replica.database() is model.replica_db
+        assert model.Account.select()._database is model.replica_db
+
+        # reads inside a transaction stay with it
+        with model.peewee_db.atomic():
+            assert model.Replica.database() is model.peewee_db
+
+        # and after writing the rest of the request reads its own writes
+        self.createAccount()
+        assert route.wrote
+        assert model.Replica.database() is model.peewee_db
+        assert model.Account.select()._database is model.peewee_db
+
+    def test_lag(self):
+        orig = model.constants.DB_REPLICA_MAX_LAG
+        model.constants.DB_REPLICA_MAX_LAG = -1
+        model.Replica.route(replica=True)
+        try:
+            with self.assertLogs(level='WARNING'):
+                model.Replica.check()
+        finally:
+            model.constants.DB_REPLICA_MAX_LAG = orig
+        assert not model.Replica.healthy
+        assert model.Replica.database() is model.peewee_db
+
+        model.Replica.check()
+        assert model.Replica.database() is model.replica_db
+
+        # an old result isn't trusted, in case the checks have stopped
+        model.Replica.checked_at -= model.Replica.CHECK_SECONDS * 2
+        assert model.Replica.database() is model.peewee_db
+
+    @async_test
+    async def test_checkLater(self):
+        # the check runs in the database executor rather than on the IOLoop
+        threads = []
+        orig = model.Replica.check
+        model.Replica.check = lambda: threads.append(threading.current_thread()) or orig()
+        try:
+            await model.Replica.checkLater()
+            assert len(threads) == 1
+            assert threads[0] is not threading.current_thread()
+            assert model.Replica.healthy
+
+            # except while it's waiting to retry after failing
+            model.Replica.check_after = time.monotonic() + 60
+            await model.Replica.checkLater()
+            assert len(threads) == 1
+        finally:
+            model.Replica.check = orig
+
+    def test_failed(self):
+        self.createAccount()
+        model.replica_db.close()
+        model.replica_db = model.ReplicaDatabase('trestle_missing', user='nobody', host=model.constants.DB_HOST,
+            port=model.constants.DB_PORT, autoconnect=True)
+        model.Replica.route(replica=True)
+
+        with self.assertLogs(level='WARNING'):
+            model.Replica.check()
+        assert not model.Replica.healthy
+        assert model.Replica.database() is model.peewee_db
+        assert model.Replica.check_after > time.monotonic() + model.Replica.RETRY_SECONDS - 5
+
+        # a replica that goes away between checks falls back to the primary for the query too
+        model.Replica.healthy = True
+        model.Replica.checked_at = time.monotonic()
+        query = model.Account.select()
+        assert query._database is model.replica_db
+        with self.assertLogs(level='WARNING'):
+            assert query.count() == 1
+        assert not model.Replica.healthy
+
+    @async_test
+    async def test_async_db(self):
+        # work in another thread is routed like the request that sent it there
+        def database():
+            return model.Account.select()._database
+
+        assert await model.async_db(database) is model.peewee_db
+        model.Replica.route(replica=True)
+        model.Replica.check()
+        assert await model.async_db(database) is model.replica_db
+
+
+class TestQueryStats(BaseTestCase):
+
+    def tearDown(self):
+        model.QUERIES.set(None)
+        super(TestQueryStats, self).tearDown()
+
+    def test_record(self):
+        stats = model.QueryStats()
+        stats.record('SELECT * FROM "auth" WHERE ("id" IN (%s, %s))', 0.5)
+        stats.record('SELECT * FROM "auth" WHERE ("id" IN (%s, %s, %s))', 0.25)
+        stats.record('SELECT * FROM "auth" WHERE ("id" = %s)', 0.25)
+
+        assert stats.count == 3
+        assert stats.seconds == 1
+        assert stats.shapes == {'SELECT * FROM "auth" WHERE ("id" IN (%s...))': 2,
+            'SELECT * FROM "auth" WHERE ("id" = %s)': 1}
+        assert stats.repeated(limit=1) == [('SELECT * FROM "auth" WHERE ("id" IN (%s...))', 2)]
+        assert stats.repeated() == []
+        assert stats.serverTiming() == 'db;dur=1000.0;desc="3 queries"'
+
+    def test_execute(self):
+        # queries are only counted during a request
+        self.createAccount()
+        stats = model.QueryStats.start()
+        assert model.Account.select().count() == 1
+        model.peewee_db.execute_sql('SELECT 1')
+        assert stats.count == 2
+        assert stats.seconds > 0
+
+
+class TestIdentityMap(BaseTestCase):
+
+    def setUp(self):
+        super(TestIdentityMap, self).setUp()
+        self.identities = model.IdentityMap.start()
+        self.stats = model.QueryStats.start()
+
+    def tearDown(self):
+        model.IDENTITIES.set(None)
+        model.QUERIES.set(None)
+        super(TestIdentityMap, self).tearDown()
+
+    def test_getBySlug(self):
+        account = self.createAccount()
+        # saving puts it in the map
+        assert model.Account.getBySlug(account.id) is account
+        assert model.Account.getBySlug(account.slug) is account
+
+        self.identities.rows.clear()
+        self.stats.count = 0
+        found = model.Account.getBySlug(account.id)
+        assert found is not account
+        assert model.Account.getBySlug(account.id) is found
+        assert found.refresh() is found
+        assert self.stats.count == 1
+
+        # a row loaded another way still gives back the same instance
+        assert model.Account.getByEmail(account.email) is found
+        assert model.Account.getBySlug(account.id + 1) is None
+
+        found.delete_instance()
+        assert model.IdentityMap.get(model.Account, account.id) is None
+
+    def test_getByAuth(self):
+        auth = self.createAuth()
+        self.identities.rows.clear()
+        self.stats.count = 0
+
+        account = model.Account.getByAuth(auth.slug)
+        assert account.id == self.account.id
+        assert model.Account.getBySlug(account.id) is account
+        assert model.Account.getByAuth(auth.slug) is account
+        assert model.Auth.getBySlug(auth.id).account is account
+        assert self.stats.count == 1
+
+    def test_save(self):
+        account = self.createAccount()
+        self.identities.rows.clear()
+        found = model.Account.getBySlug(account.id)
+
+        # saving a different copy of the row replaces the one in the map, so the changes are seen
+        account.email = 'changed@example.com'
+        account.save()
+        assert model.Account.getBySlug(account.id) is account
+        assert found.refresh() is account
+
+    def test_outsideRequest(self):
+        model.IDENTITIES.set(None)
+        account = self.createAccount()
+        assert model.Account.getBySlug(account.id) is not model.Account.getBySlug(account.id)
+        assert account.refresh() is not account
+        assert model.IdentityMap.add(account) is account
+
+
+class TestPrepared(BaseTestCase):
+
+    def preparedNames(self):
+        cursor = model.peewee_db.execute_sql('SELECT name FROM pg_prepared_statements')
+        return set(row[0] for row in cursor.fetchall())
+
+    def test_register(self):
+        model.Prepared.register('test_by_email', model.Account, '"email" = $1 AND "is_admin" = $2')
+        try:
+            model_class, prepare_sql, execute_sql = model.Prepared.STATEMENTS['test_by_email']
+            assert model_class is model.Account
+            assert prepare_sql.startswith('PREPARE test_by_email AS SELECT "id", "created_dt", "modified_dt", "email"')
+            assert prepare_sql.endswith(' FROM "account" WHERE "email" = $1 AND "is_admin" = $2')
+            assert execute_sql == 'EXECUTE test_by_email (%s, %s)'
+        finally:
+            del model.Prepared.STATEMENTS['test_by_email']
+
+    def test_first(self):
+        account = self.createAccount()
+        auth = self.createAuth()
+
+        found = model.Prepared.first('account_by_email', account.email)
+        assert found.id == account.id
+        assert found.email == account.email
+        assert not found.is_dirty()
+        assert model.Prepared.first('account_by_email', 'missing@example.com') is None
+
+        found = model.Prepared.first('auth_by_account_user_agent', account.id, auth.user_agent)
+        assert found.id == auth.id
+        assert found.account_id == account.id
+
+        # each statement is only prepared once per connection
+        connection = model.peewee_db.connection()
+        assert {'account_by_email', 'auth_by_account_user_agent'} <= model.Prepared.PREPARED[connection]
+        assert {'account_by_email', 'auth_by_account_user_agent'} <= self.preparedNames()
+
+        stats = model.QueryStats.start()
+        try:
+            assert model.Account.getBySlug(account.id).id == account.id
+            assert model.Account.getByAuth(auth.id).id == account.id
+            assert stats.count == 2
+            assert stats.shapes == {'EXECUTE account_by_id (%s)': 1, 'EXECUTE auth_with_account (%s)': 1}
+        finally:
+            model.QUERIES.set(None)
+
+        # a new connection has to prepare them again
+        model.peewee_db.close()
+        model.peewee_db.close_all()
+        assert model.Account.getByEmail(account.email).id == account.id
+        assert self.preparedNames() == {'account_by_email'}
+
+    def test_join(self):
+        model.Prepared.register('test_with_account', model.Auth, '"auth"."id" = $1', join='account')
+        try:
+            prepare_sql = model.Prepared.STATEMENTS['test_with_account'][1]
+            assert prepare_sql.startswith('PREPARE test_with_account AS SELECT "auth"."id", "auth"."created_dt"')
+            assert '"account"."email" AS "account__email"' in prepare_sql
+            assert prepare_sql.endswith(' FROM "auth" JOIN "account" ON "account"."id" = "auth"."account_id" '
+                'WHERE "auth"."id" = $1')
+        finally:
+            del model.Prepared.STATEMENTS['test_with_account']
+
+        auth = self.createAuth()
+        stats = model.QueryStats.start()
+        try:
+            found = model.Prepared.first('auth_with_account', auth.id)
+            assert found.id == auth.id
+            assert not found.is_dirty()
+
+            # the account came back with it, so using it doesn't need another query
+            assert found.account.id == self.account.id
+            assert found.account.email == self.account.email
+            assert not found.account.is_dirty()
+            assert stats.count == 1
+        finally:
+            model.QUERIES.set(None)
+
+        assert model.Prepared.first('auth_with_account', auth.id + 1) is None
+
+    def test_commit(self):
+        account = self.createAccount()
+        assert model.Account.getByEmail(account.email).id == account.id
+
+        # the connection isn't left holding a transaction open after the query
+        connection = model.peewee_db.connection()
+        assert connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+        # but inside one it's left for the transaction to finish
+        with model.peewee_db.atomic():
+            model.Account.getByEmail(account.email)
+            assert connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+    def test_error(self):
+        # a bad parameter doesn't leave the connection in an aborted transaction
+        try:
+            model.Auth.getBySlug('not a number')
+        except Exception:
+            pass
+        else:
+            assert False
+
+        assert model.Auth.getBySlug('1') is None
+        assert model.Account.select().count() == 0
+
+
+class TestAuthTouches(BaseTestCase):
+
+    def setUp(self):
+        super(TestAuthTouches, self).setUp()
+        model.AuthTouches.pending = {}
+
+    def tearDown(self):
+        model.AuthTouches.pending = {}
+        super(TestAuthTouches, self).tearDown()
+
+    def test_flush(self):
+        first = self.createAuth()
+        second = self.createAuth()
+        assert model.AuthTouches.flush() == 0
+
+        now = datetime.utcnow()
+        model.AuthTouches.touch(first.id, '127.0.0.2', now - timedelta(seconds=1))
+        model.AuthTouches.touch(first.slug, '127.0.0.3', now)
+        model.AuthTouches.touch(second.id, '127.0.0.4', now)
+        # one that's older than the last save is ignored
+        model.AuthTouches.touch(self.createAuth().id, '127.0.0.5', now - timedelta(days=1))
+        assert len(model.AuthTouches.pending) == 3
+
+        stats = model.QueryStats.start()
+        orig_size = model.AuthTouches.BATCH_SIZE
+        model.AuthTouches.BATCH_SIZE = 2
+        try:
+            assert model.AuthTouches.flush() == 2
+            assert stats.count == 2
+        finally:
+            model.AuthTouches.BATCH_SIZE = orig_size
+            model.QUERIES.set(None)
+        assert model.AuthTouches.pending == {}
+
+        first = model.Auth.getBySlug(first.id)
+        assert first.ip == '127.0.0.3'
+        assert first.modified_dt == now
+        assert model.Auth.getBySlug(second.id).ip == '127.0.0.4'
+        assert model.Auth.select().where(model.Auth.ip == '127.0.0.5').count() == 0
+
+    def test_flushError(self):
+        auth = self.createAuth()
+        model.AuthTouches.touch(auth.id, '127.0.0.2')
+
+        orig_execute = model.peewee_db.execute_sql
+
+        def execute_sql(sql, params=None, commit=None):
+            # a newer touch comes in while the write is failing
+            model.AuthTouches.touch(auth.id, '127.0.0.3')
+            raise model.OperationalError('connection lost')
+
+        model.peewee_db.execute_sql = execute_sql
+        try:
+            with self.assertLogs(level='ERROR'):
+                assert model.AuthTouches.flush() == 0
+        finally:
+            model.peewee_db.execute_sql = orig_execute
+
+        # the touch that failed doesn't replace the newer one
+        assert model.AuthTouches.pending[auth.id][1] == '127.0.0.3'
+        assert model.AuthTouches.flush() == 1
+        assert model.Auth.getBySlug(auth.id).ip == '127.0.0.3'
+
+
+class TestAsyncDB(BaseTestCase):
+
+    def runBoth(self, coro):
+        # the same checks should pass natively with asyncpg and when falling back to threads
+        orig = model.asyncpg
+        try:
+            model.asyncpg = None
+            async_test(coro)()
+
+            if asyncpg:
+                model.asyncpg = asyncpg
+                model.reset()
+                self.__dict__.pop('account', None)
+                self.__dict__.pop('auth', None)
+
+                async def native():
+                    try:
+                        await coro()
+                    finally:
+                        await model.AsyncDB.close()
+
+                async_test(native)()
+        finally:
+            model.asyncpg = orig
+
+    def test_getByAuth(self):
+        async def run():
+            auth = self.createAuth()
+            account = await model.AsyncDB.getByAuth(auth.slug)
+            assert account.id == self.account.id
+            assert account.email == self.account.email
+            assert not account.is_dirty()
+            assert await model.AsyncDB.getByAuth(auth.id + 1) is None
+
+        self.runBoth(run)
+
+    def test_getByEmail(self):
+        async def run():
+            self.createAccount()
+            account = await model.AsyncDB.getByEmail(self.account.email)
+            assert account.id == self.account.id
+            assert await model.AsyncDB.getByEmail('other' + UCHAR + '@example.com') is None
+
+        self.runBoth(run)
+
+    def test_auths(self):
+        async def run():
+            self.createAccount()
+            route = model.Replica.route()
+            assert await model.AsyncDB.touchAuth(self.account, 'test user agent' + UCHAR, '127.0.0.2') is None
+            assert not route.wrote
+
+            # writes send the rest of the request to the primary, like any other write
+            auth = await model.AsyncDB.createAuth(self.account, 'test user agent' + UCHAR, '127.0.0.1', os='test os')
+            assert auth.account_id == self.account.id
+            assert auth.os == 'test os'
+            assert route.wrote
+
+            touched = await model.AsyncDB.touchAuth(self.account, 'test user agent' + UCHAR, '127.0.0.2')
+            assert touched.id == auth.id
+            assert touched.ip == '127.0.0.2'
+            assert touched.modified_dt >= auth.modified_dt
+            assert not touched.is_dirty()
+
+            # the write happens with the next flush
+            assert model.Auth.getBySlug(auth.id).ip == '127.0.0.1'
+            assert await model.async_db(model.AuthTouches.flush) == 1
+            assert model.Auth.getBySlug(auth.id).ip == '127.0.0.2'
+
+            route = model.Replica.route()
+            assert await model.AsyncDB.deleteAuth(auth.slug) == 1
+            assert route.wrote
+            assert await model.AsyncDB.deleteAuth(auth.slug) == 0
+            model.ROUTE.set(None)
+
+        self.runBoth(run)
+
 
 class TestAccount(BaseTestCase):
 
@@ -65,9 +621,67 @@ class TestAccount(BaseTestCase):
 
         assert password_salt == b"Y29uc3RhbnQ=" # "constant" base64 encoded
 
-        hsh = "9a079faf77c18c1d4169bfa9bc77a1216e2a9ecfd6537db0c1e21dcaaf0bbb"
-        hsh += "8d5f62749c0602c8a31edff2a6b9a5ac91df84ebff9581131ba648af7263e1bd62"
-        assert hashed_password == hsh
+        # the cost is set low for tests in _base.py
+        assert hashed_password == model.Account.derivePassword("test password" + UCHAR, password_salt, cost=1)
+        assert hashed_password.startswith('scrypt$1$')
+        assert len(hashed_password) == len('scrypt$1$') + 128
+
+    def test_derivePassword(self):
+        result = model.Account.derivePassword("test password" + UCHAR, ("test salt" + UCHAR).encode('utf8'), cost=4)
+        assert result == ('scrypt$4$' + hashlib.scrypt(("test password" + UCHAR).encode('utf8'),
+            salt=("test salt" + UCHAR).encode('utf8'), n=16, r=8, p=1, dklen=64).hex())
+
+    def test_checkPassword(self):
+        password = "test password" + UCHAR
+        salt, hashed_password = model.Account.changePassword(password)
+        assert model.Account.checkPassword(password, salt.decode(), hashed_password) == (True, None)
+        assert model.Account.checkPassword("wrong password", salt.decode(), hashed_password) == (False, None)
+
+        # a password from before scrypt, or from a different cost, gets a new hash along with matching
+        old_hash = model.Account.hashPassword(password, salt)
+        matches, upgrade = model.Account.checkPassword(password, salt.decode(), old_hash)
+        assert matches
+        new_salt, new_hash = upgrade
+        assert new_salt != salt.decode()
+        assert model.Account.checkPassword(password, new_salt, new_hash) == (True, None)
+        assert model.Account.checkPassword("wrong password", salt.decode(), old_hash) == (False, None)
+
+        other_cost = model.Account.derivePassword(password, salt, cost=2)
+        matches, upgrade = model.Account.checkPassword(password, salt.decode(), other_cost)
+        assert matches
+        assert upgrade[1].startswith('scrypt$1$')
+
+    def test_passwordsStart(self):
+        # every process is forked up front rather than on the first login
+        orig = model.Passwords.EXECUTOR
+        model.Passwords.EXECUTOR = None
+        try:
+            model.Passwords.start()
+            assert len(model.Passwords.EXECUTOR._processes) == model.constants.PASSWORD_HASH_WORKERS
+        finally:
+            model.Passwords.EXECUTOR.shutdown()
+            model.Passwords.EXECUTOR = orig
+
+    @async_test
+    async def test_passwords(self):
+        account = self.createAccount()
+        salt, hashed_password = await model.Passwords.change(account.password)
+        assert model.Account.checkPassword(account.password, salt.decode(), hashed_password) == (True, None)
+
+        # an old hash is replaced the first time the password is checked
+        account = model.Account.getBySlug(account.id)
+        account.hashed_password = model.Account.hashPassword(self.account.password, account.password_salt.encode())
+        account.save()
+        assert not await model.Passwords.check(account, 'wrong password')
+
+        account = model.Account.getBySlug(account.id)
+        assert await model.Passwords.check(account, self.account.password)
+        assert model.Account.getBySlug(account.id).hashed_password.startswith('scrypt$')
+        assert await model.Passwords.check(model.Account.getBySlug(account.id), self.account.password)
+
+        # without an account it still hashes the password at the current cost, but never matches
+        assert not await model.Passwords.check(None, self.account.password)
+        assert not await model.Passwords.check(None, '')
 
     def test_getAuth(self):
         self.createAuth()
@@ -89,3 +703,52 @@ class TestAccount(BaseTestCase):
 
         assert token == "Y29uc3RhbnQ" # "constant" base64 encoded for URLs
         assert (datetime.utcnow() - account.token_dt).total_seconds() < 1 # should be very fresh
+
+
+class TestAuth(BaseTestCase):
+
+    def test_partitionStart(self):
+        # partitions run monday to monday
+        assert model.Auth.partitionStart(date(2020, 6, 1)) == date(2020, 6, 1)
+        assert model.Auth.partitionStart(datetime(2020, 6, 7, 23, 59)) == date(2020, 6, 1)
+        assert model.Auth.partitionStart(date(2020, 6, 8)) == date(2020, 6, 8)
+        assert model.Auth.partitionName(date(2020, 6, 8)) == 'auth_p20200608'
+
+    def test_addPartitions(self):
+        # reset creates the default partition plus this week and the ones ahead
+        start = model.Auth.partitionStart(datetime.utcnow())
+        weeks = [model.Auth.partitionName(start + timedelta(days=i * 7))
+            for i in range(model.Auth.PARTITIONS_AHEAD + 1)]
+        assert model.Auth.partitions() == ['auth_default'] + weeks
+        assert model.Auth.addPartitions() == []
+
+        # rows that landed in the default partition get moved when their week is created
+        auth = self.createAuth()
+        next_week = datetime.utcnow() + timedelta(days=(model.Auth.PARTITIONS_AHEAD + 1) * 7)
+        auth.modified_dt = next_week
+        super(model.BaseModel, auth).save()
+        assert model.peewee_db.execute_sql('SELECT COUNT(*) FROM auth_default').fetchone()[0] == 1
+
+        added = model.Auth.addPartitions(next_week)
+        assert added == [model.Auth.partitionName(model.Auth.partitionStart(next_week) + timedelta(days=i * 7))
+            for i in range(model.Auth.PARTITIONS_AHEAD + 1)]
+        assert model.peewee_db.execute_sql('SELECT COUNT(*) FROM auth_default').fetchone()[0] == 0
+        assert model.Auth.getBySlug(auth.id).modified_dt == next_week
+
+    def test_dropPartitions(self):
+        self.createAuth()
+        last_week = datetime.utcnow() - timedelta(days=7)
+        model.Auth.addPartitions(last_week)
+        old = self.createAuth()
+        old.modified_dt = last_week
+        super(model.BaseModel, old).save()
+
+        # nothing is dropped until the whole week is older than the cutoff
+        assert model.Auth.dropPartitions(last_week) == []
+        assert model.Auth.select().count() == 2
+
+        dropped = model.Auth.dropPartitions(datetime.utcnow())
+        assert dropped == [model.Auth.partitionName(model.Auth.partitionStart(last_week))]
+        assert dropped[0] not in model.Auth.partitions()
+        assert model.Auth.select().count() == 1
+        assert model.Auth.getBySlug(old.id) is None
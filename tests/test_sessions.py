@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+from _base import BaseTestCase
+import model
+import sessions
+
+
+class TestSessions(BaseTestCase):
+
+    def checkStore(self, store):
+        assert store.load('missing') is None
+
+        store.save('sid', b'jdata', 60)
+        assert store.load('sid') == b'jdata'
+
+        store.save('sid', b'jchanged', 60)
+        assert store.load('sid') == b'jchanged'
+
+        store.delete('sid')
+        assert store.load('sid') is None
+
+        # expired sessions aren't loaded, and get cleaned up in batches
+        for i in range(5):
+            store.save('expired' + str(i), b'jold', -1)
+        store.save('current', b'jnew', 60)
+        assert store.load('expired0') is None
+        assert store.cleanup(batch_size=2) == 5
+        assert store.load('current') == b'jnew'
+        assert store.cleanup() == 0
+
+    def test_memory(self):
+        store = sessions.MemorySessionStore()
+        self.checkStore(store)
+        assert list(store.sessions) == ['current']
+
+        # expired sessions are also removed as it goes
+        store.save('expired', b'jold', -1)
+        store.saves = store.CLEANUP_EVERY - 1
+        store.save('other', b'jnew', 60)
+        assert 'expired' not in store.sessions
+
+    def test_postgres(self):
+        store = sessions.PostgresSessionStore()
+        self.checkStore(store)
+        assert [row.id for row in model.SessionData.select()] == ['current']
+
+        row = model.SessionData.getBySlug('current')
+        assert row.expires_dt > datetime.utcnow() + timedelta(seconds=50)
+
+    def test_makeSessionStore(self):
+        assert sessions.makeSessionStore(None) is None
+        assert isinstance(sessions.makeSessionStore('memory'), sessions.MemorySessionStore)
+        assert isinstance(sessions.makeSessionStore('postgres'), sessions.PostgresSessionStore)
+
+    def test_newSessionId(self):
+        sid = sessions.newSessionId()
+        assert len(sid) == 43
+        assert sid != sessions.newSessionId()